@@ -13,6 +13,7 @@ import hashlib
 import json
 import shutil
 import os
+import wavstream
 
 class AttachFactory(WebSocketServerFactory):
     def __init__(self, attachdir="db/_attachments"):
@@ -41,16 +42,17 @@ class AttachFactory(WebSocketServerFactory):
 
     def import_file(self, filepath):
         # Moves a file into the attachment store and returns the path
+        return move_to_database(filepath, file_sha1(filepath), self.attachdir)
 
-        # Compute hash
-        sha1 = hashlib.sha1()
-        with open(filepath) as fh:
-            buf = fh.read(2**15)
-            while len(buf) > 0:
-                sha1.update(buf)
-                buf = fh.read(2**15)
-                
-        return move_to_database(filepath ,sha1.hexdigest(), self.attachdir)
+    def import_stream(self, writer):
+        # Finishes a wavstream.WavWriter in the attachment store,
+        # named by the hash of its samples, and returns the path
+        return move_to_database(writer.close(), writer.hexdigest(), self.attachdir)
+
+    def import_wav(self, path):
+        # Moves a WAV into the attachment store, named as
+        # `import_stream' would have named it
+        return move_to_database(path, wavstream.samples_sha1(path), self.attachdir)
 
     def onupload(self, cmd):
         print 'upload complete', cmd
@@ -99,6 +101,19 @@ class AttachProtocol(WebSocketServerProtocol):
                 self.sendMessage(json.dumps({"type": "got-chunk", "id": self.cur_id, "size": self.cur_size}))
 
 
+def file_sha1(filepath):
+    sha1 = hashlib.sha1()
+    with open(filepath) as fh:
+        buf = fh.read(2**15)
+        while len(buf) > 0:
+            sha1.update(buf)
+            buf = fh.read(2**15)
+    return sha1.hexdigest()
+
+def path_sha1(hashpath):
+    # Inverse of `move_to_database'
+    return os.path.dirname(hashpath) + os.path.splitext(os.path.basename(hashpath))[0]
+
 def move_to_database(filename, hashstr, attachdir, ext=None):
     if ext is None:
         _r, ext = os.path.splitext(filename)
@@ -0,0 +1,186 @@
+# Kaldi decoders hosted in worker processes, so that the Python side
+# of decoding (buffer handling, parsing results) doesn't compete with
+# the reactor for the GIL, and a decoder that crashes can't take the
+# server down with it.
+#
+# A ProcessKaldi behaves like a standard_kaldi.Kaldi. Audio that lives
+# in a `shared_array' is handed over by reference (`push_shared'): the
+# worker maps the same file, so no samples are pickled.
+#
+# Workers are forked from a launcher process rather than from the
+# server, which by the time it needs a decoder has threads, listening
+# sockets, open recordings and memory maps that a worker shouldn't
+# hold on to. The launcher is started by `start_launcher', before the
+# server opens anything; each worker then connects back to the server
+# over a unix socket of its own.
+
+import _multiprocessing
+import multiprocessing
+import multiprocessing.connection
+import numpy as np
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+
+# Shared arrays are memory-mapped files in here (tmpfs, if possible)
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Seconds to wait for a new worker to connect
+CONNECT_TIMEOUT = 30
+
+class DecoderError(IOError):
+    pass
+
+_launcher = None                # (process, connection, lock)
+_launcher_lock = threading.Lock()
+
+def shared_array(shape):
+    "returns (int16 array, path) for an array that worker processes can map"
+    fd, path = tempfile.mkstemp(prefix='earmark-', suffix='.pcm', dir=SHM_DIR)
+    os.close(fd)
+    return np.memmap(path, dtype=np.int16, mode='w+', shape=shape), path
+
+def start_launcher():
+    "starts the process that workers are forked from, if it isn't running"
+    global _launcher
+    with _launcher_lock:
+        if _launcher is None:
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=launch, args=(child_conn, conn))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            _launcher = (proc, conn, threading.Lock())
+        return _launcher
+
+def launch(conn, parent_conn):
+    # Launcher process: forks a worker for each (address, kaldi_args)
+    # from `conn', and answers with its pid
+    parent_conn.close()
+    # (in case we were started late, don't pass on the server's files)
+    os.closerange(3, conn.fileno())
+    os.closerange(conn.fileno() + 1, os.sysconf('SC_OPEN_MAX'))
+    # (and have workers reaped as they exit, for `is_alive')
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    while True:
+        try:
+            address, kaldi_args = conn.recv()
+        except EOFError:
+            # Server went away
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            try:
+                serve(multiprocessing.connection.Client(address), kaldi_args)
+            finally:
+                os._exit(0)
+        conn.send(pid)
+
+def serve(conn, kaldi_args):
+    # Worker process: runs commands from `conn' against one decoder
+    from gentle import standard_kaldi
+    k = standard_kaldi.Kaldi(*kaldi_args)
+
+    maps = {}                   # path -> memmap
+    while True:
+        try:
+            cmd = conn.recv()
+        except EOFError:
+            # Parent went away
+            k.stop()
+            return
+
+        if cmd[0] == 'push-shared':
+            path, start, end = cmd[1:]
+            if path not in maps:
+                maps[path] = np.memmap(path, dtype=np.int16, mode='r')
+            conn.send(k.push_chunk(np.getbuffer(maps[path][start:end])))
+        elif cmd[0] == 'push':
+            conn.send(k.push_chunk(cmd[1]))
+        elif cmd[0] == 'partial':
+            conn.send(k.get_partial())
+        elif cmd[0] == 'final':
+            conn.send(k.get_final())
+        elif cmd[0] == 'pid':
+            # (of the decoder proper, for CPU accounting)
+            conn.send(k._p.pid)
+        elif cmd[0] == 'reset':
+            # (let go of finished sessions' audio)
+            maps = {}
+            conn.send(k.reset())
+        elif cmd[0] == 'stop':
+            k.stop()
+            conn.send(None)
+            return
+
+class ProcessKaldi:
+    def __init__(self, *kaldi_args):
+        _proc, launcher, lock = start_launcher()
+
+        sockdir = tempfile.mkdtemp(prefix='earmark-')
+        address = os.path.join(sockdir, 'decoder')
+        listener = socket.socket(socket.AF_UNIX)
+        try:
+            listener.bind(address)
+            listener.listen(1)
+            listener.settimeout(CONNECT_TIMEOUT)
+            with lock:
+                launcher.send((address, kaldi_args))
+                self.worker_pid = launcher.recv()
+            sock, _addr = listener.accept()
+        except (EOFError, IOError, socket.error):
+            raise DecoderError('could not start a decoder process')
+        finally:
+            listener.close()
+            shutil.rmtree(sockdir)
+
+        sock.setblocking(True)
+        self.conn = _multiprocessing.Connection(os.dup(sock.fileno()))
+        sock.close()
+
+    def _call(self, *cmd):
+        try:
+            self.conn.send(cmd)
+            return self.conn.recv()
+        except (EOFError, IOError):
+            raise DecoderError('decoder process %d died' % (self.worker_pid))
+
+    def push_shared(self, path, start, end):
+        return self._call('push-shared', path, start, end)
+
+    def push_chunk(self, buf):
+        return self._call('push', str(buf))
+
+    def get_partial(self):
+        return self._call('partial')
+
+    def get_final(self):
+        return self._call('final')
+
+    def reset(self):
+        return self._call('reset')
+
+    def decoder_pid(self):
+        if not hasattr(self, 'pid'):
+            self.pid = self._call('pid')
+        return self.pid
+
+    def stop(self):
+        try:
+            self._call('stop')
+        except DecoderError:
+            pass
+        self.conn.close()
+
+    def is_alive(self):
+        try:
+            os.kill(self.worker_pid, 0)
+        except OSError:
+            return False
+        return True
@@ -5,30 +5,415 @@ from autobahn.twisted.websocket import WebSocketServerProtocol, \
 from autobahn.twisted.resource import WebSocketResource
 from twisted.web.static import File
 from twisted.web.server import Site
-from twisted.internet import reactor
+from twisted.internet import reactor, task, threads
 
+import bisect
 import gzip
 import json
 import os
+import time
+
+import wordarray
+
+# Maximum number of docs (or changes) per history message
+HISTORY_CHUNK = 500
+
+# Checkpoint once this many bytes have been logged, or every
+# CHECKPOINT_INTERVAL seconds if anything has changed
+CHECKPOINT_BYTES = 2**24
+CHECKPOINT_INTERVAL = 600
+
+# At most this many bytes of recent changes are kept for clients that
+# reconnect; clients that are further behind get a full snapshot
+RECENT_BYTES = 2**23
+
+# Format of db.json: {"version", "seq", "docs"}. (Earlier ones were
+# {"seq", "docs"}, and before that just the docs.)
+SNAPSHOT_VERSION = 1
+
+# Changelog durability: "flush" or "fsync" after every batch, or
+# "interval" to flush every batch and fsync every FSYNC_INTERVAL ms
+DURABILITY = "flush"
+FSYNC_INTERVAL = 200
+
+# Minimum seconds between broadcasts of preview updates to a single doc
+PREVIEW_INTERVAL = 0.25
+
+class ChangeLog:
+    # Group-commit writer: all of the changes logged during a reactor
+    # turn are written out together. Each change may come with an
+    # `onwritten' callback, which is called (in order) once the change
+    # is as durable as `durability' makes it.
+
+    def __init__(self, path, durability=DURABILITY, fsync_interval=FSYNC_INTERVAL):
+        self.path = path
+        self.durability = durability
+
+        self.fh = open(path, 'a')
+        self.pending = []       # lines waiting for the next batch
+        self.onwritten = []     # their callbacks
+        self.flush_call = None
+        self.unsynced = False
+
+        self.stats = {"durability": durability,
+                      "batches": 0,
+                      "changes": 0,
+                      "bytes": 0,
+                      "last_batch": 0,
+                      "max_batch": 0,
+                      "last_write_ms": 0,
+                      "max_write_ms": 0,
+                      "total_write_ms": 0}
+
+        if durability == "interval":
+            self.fsync_loop = task.LoopingCall(self.fsync)
+            self.fsync_loop.start(fsync_interval / 1000.0, now=False)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.shutdown)
+
+    def append(self, line, onwritten=None):
+        self.pending.append(line)
+        if onwritten is not None:
+            self.onwritten.append(onwritten)
+        if self.flush_call is None:
+            self.flush_call = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        if len(self.pending) == 0:
+            return
+
+        start = time.time()
+
+        data = "".join(["%s\n" % (X) for X in self.pending])
+        self.fh.write(data)
+        self.fh.flush()
+        if self.durability == "fsync":
+            os.fsync(self.fh.fileno())
+        else:
+            self.unsynced = True
+
+        write_ms = 1000 * (time.time() - start)
+        self.stats["batches"] += 1
+        self.stats["changes"] += len(self.pending)
+        self.stats["bytes"] += len(data)
+        self.stats["last_batch"] = len(self.pending)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(self.pending))
+        self.stats["last_write_ms"] = write_ms
+        self.stats["max_write_ms"] = max(self.stats["max_write_ms"], write_ms)
+        self.stats["total_write_ms"] += write_ms
+
+        self.pending = []
+        onwritten, self.onwritten = self.onwritten, []
+        for fn in onwritten:
+            fn()
+
+    def fsync(self):
+        if self.unsynced:
+            self.unsynced = False
+            os.fsync(self.fh.fileno())
+
+    def shutdown(self):
+        # Nothing logged is left behind when the reactor stops
+        self.flush()
+        self.fsync()
+
+    def rotate(self, rotated_path):
+        # Moves everything logged so far to `rotated_path'
+        self.flush()
+        self.fh.close()
+        os.rename(self.path, rotated_path)
+        self.fh = open(self.path, 'a')
+        self.unsynced = False
+
+# Docs (and changes) in JSON: word alignments are written compactly,
+# and read back as WordArrays
+def dumps(obj):
+    return json.dumps(obj, default=wordarray.encode)
+
+def loads(s):
+    return json.loads(s, object_hook=wordarray.decode)
+
+def load_snapshot(dbpath):
+    "returns (seq, docs) from a db.json checkpoint"
+    if not os.path.exists(dbpath):
+        return 0, {}
+
+    snapshot = loads(open(dbpath).read())
+    if snapshot.get("version") == SNAPSHOT_VERSION:
+        return snapshot["seq"], snapshot["docs"]
+    if isinstance(snapshot.get("seq"), int):
+        # (numbered, but from before the version field; docs are
+        # always objects)
+        return snapshot["seq"], snapshot["docs"]
+    # (just the docs)
+    return 0, snapshot
+
+def read_changes(path, seq):
+    "yields (change_doc, serialized change) for changes after `seq'"
+    if not os.path.exists(path):
+        return
+
+    for line in open(path):
+        if len(line.strip()) > 2:
+            c = loads(line)
+            if "seq" not in c:
+                # (unnumbered log)
+                c["seq"] = seq + 1
+                line = dumps(c)
+            if c["seq"] > seq:
+                seq = c["seq"]
+                yield c, line.strip()
+
+def make_patch(_id, fields, unset=()):
+    "returns a change that sets `fields' (and removes `unset') of one doc"
+    change_doc = {"type": "patch", "id": _id, "set": fields}
+    if len(unset) > 0:
+        change_doc["unset"] = list(unset)
+    return change_doc
+
+def make_batch(changes):
+    "returns a change that applies `changes' together, as one record"
+    return {"type": "batch", "changes": changes}
+
+def iter_changes(change_doc):
+    "yields the changes in a batch, or the change itself"
+    if change_doc['type'] == 'batch':
+        for X in change_doc['changes']:
+            yield X
+    else:
+        yield change_doc
+
+def patch_doc(doc, change_doc):
+    # A patch to a missing doc creates it
+    if doc is None:
+        doc = {"_id": change_doc['id']}
+    doc.update(change_doc.get('set', {}))
+    for key in change_doc.get('unset', []):
+        doc.pop(key, None)
+    return doc
+
+def apply_change(docs, change_doc):
+    if change_doc['type'] == 'batch':
+        for X in change_doc['changes']:
+            apply_change(docs, X)
+    elif change_doc['type'] == 'delete':
+        del docs[change_doc['id']]
+    elif change_doc['type'] == 'patch':
+        docs[change_doc['id']] = patch_doc(docs.get(change_doc['id']), change_doc)
+    else:
+        docs[change_doc['id']] = change_doc['doc']
+
+def merge_changes(docs, first, second):
+    """returns a single change with the effect of `first' and then
+    `second' (both of which have been applied to `docs')"""
+    if second['type'] != 'patch':
+        return second
+    if first['type'] != 'patch':
+        # (the doc as it is now)
+        return {"type": "change", "id": second['id'], "doc": docs[second['id']]}
+
+    fields = dict(first.get('set', {}))
+    fields.update(second.get('set', {}))
+    unset = [X for X in first.get('unset', []) if X not in fields]
+    for key in second.get('unset', []):
+        fields.pop(key, None)
+        if key not in unset:
+            unset.append(key)
+    return make_patch(second['id'], fields, unset)
+
+def next_archive_idx(dbdir):
+    "returns the N of the first _changes.N.gz after those in `dbdir'"
+    idxs = [0]
+    for name in os.listdir(dbdir):
+        parts = name.split('.')
+        if len(parts) == 3 and parts[0] == '_changes' and parts[2] == 'gz' and parts[1].isdigit():
+            idxs.append(int(parts[1]))
+    return max(idxs) + 1
+
+def archive_changes(dbdir, changes_file, idx):
+    # gzip a changelog into _changes.`idx'.gz, and remove it
+    changes_fh = open(changes_file)
+    changes_out_fh = gzip.open(os.path.join(dbdir, "_changes.%d.gz" % (idx)), 'wb')
+    changes_out_fh.writelines(changes_fh)
+    changes_out_fh.close()
+    changes_fh.close()
+    os.remove(changes_file)
+
+class Index:
+    # Secondary index: maps the value of `field' (or a tuple of values,
+    # if `field' is a tuple of names) to the ids of the docs that have
+    # it, ordered by `sortfield'.
+
+    def __init__(self, field, sortfield=None):
+        self.field = field
+        self.sortfield = sortfield
+
+        self.entries = {}       # key -> sorted [(sortval, _id)]
+        self.keys = {}          # _id -> (key, sortval)
+
+    def get_key(self, doc):
+        if isinstance(self.field, tuple):
+            key = tuple([doc.get(X) for X in self.field])
+            if None in key:
+                return None
+        else:
+            key = doc.get(self.field)
+
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def add(self, _id, doc):
+        key = self.get_key(doc)
+        sortval = doc.get(self.sortfield) if self.sortfield else None
+
+        if self.keys.get(_id) == (key, sortval):
+            # (docs are usually updated in-place)
+            return
+
+        self.remove(_id)
+        if key is None:
+            return
+
+        self.keys[_id] = (key, sortval)
+        bisect.insort(self.entries.setdefault(key, []), (sortval, _id))
+
+    def remove(self, _id):
+        if _id not in self.keys:
+            return
+
+        key, sortval = self.keys.pop(_id)
+        entries = self.entries[key]
+        del entries[bisect.bisect_left(entries, (sortval, _id))]
+        if len(entries) == 0:
+            del self.entries[key]
+
+    def get(self, key):
+        return [X[1] for X in self.entries.get(key, [])]
+
+class Backpressure:
+    # Streaming producer registered on a client's transport, which
+    # pauses it while the client is slow to drain. Previews are not
+    # sent to a paused client; the ids are remembered instead, and their
+    # current docs are sent when it resumes.
+    #
+    # A transport has room for one producer, and one taken over from
+    # twisted.web already has its HTTPChannel: that is `wrapped', and
+    # passed everything along.
+
+    def __init__(self, client, wrapped=None):
+        self.client = client
+        self.wrapped = wrapped
+        self.paused = False
+        self.stale = set()      # ids of previews that were not sent
+
+    def pauseProducing(self):
+        self.paused = True
+        if self.wrapped is not None:
+            self.wrapped.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.wrapped is not None:
+            self.wrapped.resumeProducing()
+
+        # (as of the latest change, like a history chunk)
+        stale, self.stale = self.stale, set()
+        for _id in stale:
+            doc = self.client.factory.get(_id)
+            if doc is not None:
+                self.client.sendMessage(dumps(
+                    {"type": "change", "id": _id, "doc": doc, "seq": self.client.factory.seq}))
+
+    def stopProducing(self):
+        self.paused = True
+        if self.wrapped is not None:
+            self.wrapped.stopProducing()
+
+def make_index(spec):
+    # (field or tuple of fields, sort field), or a class with the same
+    # add/remove/get methods as `Index'
+    if isinstance(spec, tuple):
+        return Index(*spec)
+    return spec()
 
 class DBFactory(WebSocketServerFactory):
-    def __init__(self, dbdir="db"):
+    # Changes are {"type": "change", "id", "doc"} for a whole doc,
+    # {"type": "patch", "id", "set": {fields}, "unset": [fields]} for
+    # some of its fields (see `make_patch'), {"type": "delete", "id"},
+    # or {"type": "batch", "changes": [changes]} for several at once
+    # (see `make_batch'), which are logged and sent as a single record.
+
+    # Secondary indexes, maintained by `update_inmem':
+    # name -> spec, see `make_index'. Indexes that can `dump' and `load'
+    # themselves are saved with each checkpoint (and loaded with the
+    # docs of the snapshot), and answer "query" messages if they have a
+    # `query' method.
+    INDEXES = {"type": ("type", None)}
+
+    # Fields that hold lists of word alignments, which are kept as
+    # WordArrays (see wordarray.py)
+    COMPACT_FIELDS = ()
+
+    def __init__(self, dbdir="db", durability=DURABILITY):
         WebSocketServerFactory.__init__(self)
         self.clients = {}       # peerstr -> client
 
         self.dbdir = dbdir
         self.docs = {}       # _id -> {doc}
+        self.indexes = dict([(name, make_index(spec)) for (name, spec) in self.INDEXES.items()])
+
+        # Every change gets a sequence number. Changes since the last
+        # compaction are kept (serialized, up to RECENT_BYTES) so that
+        # reconnecting clients can catch up without a full snapshot.
+        self.seq = 0
+        self.compacted_seq = 0
+        self.recent_seqs = []
+        self.recent = []
+        self.recent_bytes = 0
+        self.recent_since = 0   # clients at this seq or later can catch up
+
+        self.changes_file = os.path.join(self.dbdir, '_changes')
+        # A log that has been rotated but not yet folded into db.json
+        self.rotated_file = os.path.join(self.dbdir, '_changes.rotated')
+        self.log_size = 0       # bytes logged since the last checkpoint
+        self.checkpointing = False
+        # While a checkpoint is being written: _id -> the doc as of the
+        # checkpoint (None if it didn't exist), for each doc changed
+        # since (see `update_inmem')
+        self.snapshot = None
+
+        # Rate-limited previews: _id -> DelayedCall, and the latest
+        # preview that is waiting for it
+        self.preview_calls = {}
+        self.pending_previews = {}
 
         if os.path.exists(dbdir):
             self.load_db()
         else:
             os.makedirs(dbdir)
+        # Where the next checkpoint archives its log
+        self.archive_idx = next_archive_idx(dbdir)
+
+        # Append to the changelog
+        self.changelog = ChangeLog(self.changes_file, durability)
 
-        # Create a changelog
-        self.change_fh = open(os.path.join(self.dbdir, '_changes'), 'w')
+        self.checkpoint_loop = task.LoopingCall(self.maybe_checkpoint)
+        self.checkpoint_loop.start(CHECKPOINT_INTERVAL, now=False)
+        if self.log_size > 0:
+            # Fold the replayed tail into db.json, in the background
+            self.checkpoint()
 
     def get(self, key, default=None):
         return self.docs.get(key, default)
+    def find(self, index, key):
+        "returns the docs with `key' in `index', in index order"
+        return [self.docs[X] for X in self.indexes[index].get(key)]
     def __getitem__(self, key):
         return self.docs.__getitem__(key)
     def __setitem__(self, key, value):
@@ -38,65 +423,320 @@ class DBFactory(WebSocketServerFactory):
         # TODO
         pass
 
+    def index_path(self, name):
+        return os.path.join(self.dbdir, '_index.%s.json' % (name))
+
     def load_db(self):
-        # Load into self.db
+        # Load the last checkpoint, then replay the changes since
+        self.seq, self.docs = load_snapshot(os.path.join(self.dbdir, 'db.json'))
+        self.compacted_seq = self.seq
+        self.recent_since = self.seq
+        for doc in self.docs.values():
+            # (from before alignments were compact)
+            self.compact(doc)
+
+        # Saved indexes, if they match the snapshot
+        build = []
+        for (name, index) in self.indexes.items():
+            saved = None
+            if hasattr(index, 'load') and os.path.exists(self.index_path(name)):
+                saved = json.load(open(self.index_path(name)))
+            if saved is not None and saved["seq"] == self.seq:
+                try:
+                    index.load(saved["index"], self.docs)
+                    continue
+                except ValueError:
+                    # (saved by another version)
+                    pass
+            build.append(index)
+
+        for (_id, doc) in self.docs.items():
+            for index in build:
+                index.add(_id, doc)
+
+        for path in [self.rotated_file, self.changes_file]:
+            for (c, change_str) in read_changes(path, self.seq):
+                self.seq = c["seq"]
+                self.update_inmem(c)
+                self.remember(self.seq, change_str)
+                self.log_size += len(change_str) + 1
+
+    def maybe_checkpoint(self):
+        if self.seq > self.compacted_seq:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Rotate the changelog, and write the docs as they are now to
+        # db.json in a thread
+        if self.checkpointing:
+            return
+        self.checkpointing = True
+
+        if not os.path.exists(self.rotated_file):
+            # (otherwise, an earlier checkpoint never finished; this
+            # one covers it too)
+            self.changelog.rotate(self.rotated_file)
+            self.log_size = 0
+
+        # The docs are read from the thread; until it is done, changes
+        # leave the ones it might be reading alone
+        self.snapshot = {}
+
+        d = threads.deferToThread(self._write_checkpoint, self.seq, self.snapshot)
+        d.addCallbacks(self._checkpoint_done, self._checkpoint_failed)
+
+    def snapshot_docs(self, snapshot):
+        # (in the checkpoint's thread) the docs as of `snapshot'; ids
+        # are listed before the docs changed since, so that one that is
+        # added or deleted meanwhile is in `snapshot' by the time it's read
+        ids = self.docs.keys()
+        ids.extend(snapshot.keys())
+        docs = {}
+        for _id in ids:
+            doc = self.docs.get(_id)
+            if _id in snapshot:
+                doc = snapshot[_id]
+            if doc is not None:
+                docs[_id] = doc
+        return docs
+
+    def _write_checkpoint(self, seq, snapshot):
+        # (runs in a thread; only touches db.json and the rotated log)
         dbpath = os.path.join(self.dbdir, 'db.json')
-        if os.path.exists(dbpath):
-            self.docs = json.load(open(dbpath))
-
-        # Incorporate changes
-        changes_file = os.path.join(self.dbdir, "_changes")
-        if os.path.exists(changes_file):
-            for line in open(changes_file):
-                if len(line.strip()) > 2:
-                    c = json.loads(line)
-                    self.update_inmem(c)
-
-            # Serialize to db.json
-            json.dump(self.docs, open(dbpath, 'w'), indent=2)
-
-            # Archive _changes
-            changes_fh = open(changes_file)
-            changes_out_pattern = os.path.join(self.dbdir, "_changes.%d.gz")
-            changes_out_idx = 1
-            while os.path.exists(changes_out_pattern % (changes_out_idx)):
-                changes_out_idx += 1
-            changes_out_fh = gzip.open(changes_out_pattern % (changes_out_idx), 'wb')
-            changes_out_fh.writelines(changes_fh)
-            changes_out_fh.close()
-            changes_fh.close()
-
-    def register(self, client):
+        docs = self.snapshot_docs(snapshot)
+
+        # Replace atomically. (`json.dump' would take the pure-Python
+        # encoder)
+        with open(dbpath + '.tmp', 'w') as fh:
+            fh.write(json.dumps({"version": SNAPSHOT_VERSION, "seq": seq, "docs": docs}, default=wordarray.encode))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(dbpath + '.tmp', dbpath)
+
+        # Indexes as of the snapshot (not the live ones, which are
+        # ahead of it); they share the docs' data rather than copying
+        for (name, spec) in self.INDEXES.items():
+            index = make_index(spec)
+            if not hasattr(index, 'dump'):
+                continue
+            for (_id, doc) in docs.items():
+                index.add(_id, doc)
+            with open(self.index_path(name) + '.tmp', 'w') as fh:
+                fh.write(json.dumps({"seq": seq, "index": index.dump()}))
+            os.rename(self.index_path(name) + '.tmp', self.index_path(name))
+
+        archive_changes(self.dbdir, self.rotated_file, self.archive_idx)
+        self.archive_idx += 1
+
+        return seq
+
+    def _checkpoint_done(self, seq):
+        self.checkpointing = False
+        self.snapshot = None
+        self.compacted_seq = seq
+
+        # Clients behind the checkpoint will get a full history
+        self.forget(seq)
+
+    def _checkpoint_failed(self, err):
+        print 'checkpoint failed', err
+        self.checkpointing = False
+        self.snapshot = None
+
+    def register(self, client, since=None):
         self.clients[client.peer] = client
 
-        # Send history
-        client.sendMessage(json.dumps(
-            {"type": "history",
-             "history": self.docs}))
+        if since is not None and self.recent_since <= since <= self.seq:
+            self.send_changes(client, since)
+        else:
+            self.send_history(client)
+
+    def remember(self, seq, change_str):
+        self.recent_seqs.append(seq)
+        self.recent.append(change_str)
+        self.recent_bytes += len(change_str)
+
+        if self.recent_bytes > RECENT_BYTES:
+            # Down to 3/4 of the limit, so that this isn't every time
+            n = 0
+            left = self.recent_bytes
+            while left > RECENT_BYTES * 3 / 4:
+                left -= len(self.recent[n])
+                n += 1
+            self.forget(self.recent_seqs[n - 1])
+
+    def forget(self, seq):
+        # Drops the recent changes up to `seq'
+        idx = bisect.bisect_right(self.recent_seqs, seq)
+        self.recent_bytes -= sum([len(X) for X in self.recent[:idx]])
+        del self.recent_seqs[:idx]
+        del self.recent[:idx]
+        self.recent_since = max(self.recent_since, seq)
+
+    def send_changes(self, client, since):
+        # Send only the changes that the client has missed
+        start = bisect.bisect_right(self.recent_seqs, since)
+        for idx in range(start, max(start + 1, len(self.recent)), HISTORY_CHUNK):
+            chunk = self.recent[idx:idx+HISTORY_CHUNK]
+            client.sendMessage('{"type": "changes", "seq": %d, "changes": [%s]}' % (
+                self.seq, ", ".join(chunk)))
+
+    def send_history(self, client):
+        # Stream a full snapshot, a chunk per reactor turn. Each chunk
+        # holds the docs as they are when it is sent, and any change
+        # made in the meantime is broadcast as usual, so the client
+        # ends up consistent. (The first chunk, which resets the
+        # client, is sent right away.)
+        ids = self.docs.keys()
+
+        def chunks():
+            for idx in range(0, max(1, len(ids)), HISTORY_CHUNK):
+                if self.clients.get(client.peer) is not client:
+                    return
+                history = dict([(X, self.docs[X]) for X in ids[idx:idx+HISTORY_CHUNK] if X in self.docs])
+                client.sendMessage(dumps(
+                    {"type": "history",
+                     "seq": self.seq,
+                     "first": idx == 0,
+                     "last": idx + HISTORY_CHUNK >= len(ids),
+                     "history": history}))
+                yield
+
+        chunker = chunks()
+        chunker.next()
+        task.cooperate(chunker)
 
     def unregister(self, client):
         if client.peer in self.clients:
             del self.clients[client.peer]
 
+    def compact(self, fields):
+        for key in self.COMPACT_FIELDS:
+            if isinstance(fields.get(key), list):
+                words = wordarray.from_words(fields[key])
+                if words is not None:
+                    fields[key] = words
+
     def update_inmem(self, change_doc):
-        if change_doc['type'] == 'delete':
-            del self.docs[change_doc['id']]
+        for c in iter_changes(change_doc):
+            # (in the change itself, so that it is logged and sent
+            # compactly too)
+            if c['type'] == 'patch':
+                self.compact(c.get('set', {}))
+            elif c['type'] != 'delete':
+                self.compact(c['doc'])
+
+            if self.snapshot is not None and c['id'] not in self.snapshot:
+                # (a checkpoint is reading the docs: it gets this one as
+                # it was, and a patch goes to a copy)
+                doc = self.docs.get(c['id'])
+                self.snapshot[c['id']] = doc
+                if doc is not None and c['type'] == 'patch':
+                    self.docs[c['id']] = dict(doc)
+            apply_change(self.docs, c)
+
+            if c['type'] == 'delete':
+                for index in self.indexes.values():
+                    index.remove(c['id'])
+            else:
+                for index in self.indexes.values():
+                    index.add(c['id'], self.docs[c['id']])
+
+    def onpreview(self, change_doc):
+        # Like `onchange', for transient updates: at most one per doc is
+        # sent per PREVIEW_INTERVAL, and the last one wins (patches
+        # are merged).
+        _id = change_doc["id"]
+        if _id in self.preview_calls:
+            self.update_inmem(change_doc)
+            if _id in self.pending_previews:
+                change_doc = merge_changes(self.docs, self.pending_previews[_id], change_doc)
+            self.pending_previews[_id] = change_doc
         else:
-            self.docs[change_doc['id']] = change_doc['doc']
+            self.commit(None, change_doc, preview=True)
+            self.preview_calls[_id] = reactor.callLater(PREVIEW_INTERVAL, self._preview_due, _id)
+
+    def _preview_due(self, _id):
+        del self.preview_calls[_id]
+        change_doc = self.pending_previews.pop(_id, None)
+        if change_doc is not None:
+            self.onpreview(change_doc)
 
     def onchange(self, sender, change_doc):
+        self.commit(sender, change_doc)
+
+    def onquery(self, sender, query):
+        # {"type": "query", "index": name, "qid": id, ...}; the rest is
+        # up to the index
+        index = self.indexes.get(query.get("index"))
+        if hasattr(index, 'query'):
+            results = index.query(query)
+        else:
+            results = None
+        sender.sendMessage(json.dumps({"type": "query-result",
+                                       "qid": query.get("qid"),
+                                       "results": results}))
+
+    def supersede_preview(self, change_doc):
+        # A change supersedes any preview of the doc that has yet to be
+        # sent; a patch takes the preview's fields along
+        if change_doc["id"] not in self.pending_previews:
+            return change_doc
+        return merge_changes(self.docs, self.pending_previews.pop(change_doc["id"]), change_doc)
+
+    def commit(self, sender, change_doc, preview=False):
         self.update_inmem(change_doc)
 
-        self.change_fh.write("%s\n" % (json.dumps(change_doc)))
-        self.change_fh.flush()
-        
+        if preview:
+            pass
+        elif change_doc["type"] == "batch":
+            change_doc["changes"] = [self.supersede_preview(X) for X in change_doc["changes"]]
+        else:
+            change_doc = self.supersede_preview(change_doc)
+
+        self.seq += 1
+        change_doc["seq"] = self.seq
+        change_str = dumps(change_doc)
+        self.remember(self.seq, change_str)
+
+        # (clients only hear of it once it is in the log)
+        self.changelog.append(change_str, lambda: self.broadcast(sender, change_doc, change_str, preview))
+
+        self.log_size += len(change_str) + 1
+        if self.log_size >= CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def broadcast(self, sender, change_doc, change_str, preview=False):
+        # Serialized once, for every client
         for client in self.clients.values():
-            if client != sender:
-                client.sendMessage(json.dumps(change_doc))
+            if client == sender:
+                continue
+            if not preview:
+                for c in iter_changes(change_doc):
+                    if c["type"] != "patch":
+                        # (a patch may not cover every field of the skipped previews)
+                        client.backpressure.stale.discard(c["id"])
+                client.sendMessage(change_str)
+            elif client.backpressure.paused:
+                client.backpressure.stale.add(change_doc["id"])
+            else:
+                client.sendMessage(change_str)
 
 class DBProtocol(WebSocketServerProtocol):
+    def onConnect(self, request):
+        # Clients that reconnect pass the last sequence number they saw
+        try:
+            self.since = int(request.params["since"][0])
+        except (KeyError, ValueError):
+            self.since = None
+
     def onOpen(self):
-        self.factory.register(self)
+        self.backpressure = Backpressure(self, getattr(self.transport, 'producer', None))
+        if self.backpressure.wrapped is not None:
+            self.transport.unregisterProducer()
+        self.transport.registerProducer(self.backpressure, True)
+
+        self.factory.register(self, self.since)
         WebSocketServerProtocol.onOpen(self)
 
     def connectionLost(self, reason):
@@ -106,7 +746,10 @@ class DBProtocol(WebSocketServerProtocol):
     def onMessage(self, payload, isBinary):
         if not isBinary:
             change_doc = json.loads(payload)
-            self.factory.onchange(self, change_doc)
+            if change_doc.get("type") == "query":
+                self.factory.onquery(self, change_doc)
+            else:
+                self.factory.onchange(self, change_doc)
 
 if __name__=='__main__':
     factory = DBFactory()
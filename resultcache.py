@@ -0,0 +1,86 @@
+# Persistent cache of command decodes, keyed by (audio sha1, graph
+# hash). Decoding the same audio against the same command set gives
+# the same words, whichever database asked, so re-runs after an undo
+# (or for a command set shared between databases) are free.
+#
+# Each entry is a small JSON file; once the total is over `max_bytes',
+# the least-recently-used entries are removed.
+
+import collections
+import json
+import os
+import tempfile
+import threading
+
+RESULT_CACHE_BYTES = 2**26
+
+class ResultCache:
+    def __init__(self, cachedir, max_bytes=RESULT_CACHE_BYTES):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        try:
+            os.makedirs(cachedir)
+        except OSError:
+            pass
+
+        # name -> size, least-recently-used first
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        paths = [os.path.join(cachedir, X) for X in os.listdir(cachedir) if X.endswith('.json')]
+        for path in sorted(paths, key=os.path.getmtime):
+            self.entries[os.path.basename(path)] = os.path.getsize(path)
+            self.n_bytes += self.entries[os.path.basename(path)]
+
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _name(self, audio_hash, lm_hash):
+        return '%s-%s.json' % (audio_hash, lm_hash)
+
+    def get(self, audio_hash, lm_hash):
+        "returns the cached words, or None"
+        name = self._name(audio_hash, lm_hash)
+        path = os.path.join(self.cachedir, name)
+        with self.lock:
+            if name not in self.entries:
+                self.stats["misses"] += 1
+                return None
+            self.entries[name] = self.entries.pop(name)
+            self.stats["hits"] += 1
+
+        try:
+            words = json.load(open(path))
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            # (evicted meanwhile, or damaged)
+            return None
+        return words
+
+    def put(self, audio_hash, lm_hash, words):
+        name = self._name(audio_hash, lm_hash)
+        path = os.path.join(self.cachedir, name)
+
+        # Write atomically; readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cachedir)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(words, fh)
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, path)
+
+        stale = []
+        with self.lock:
+            self.n_bytes += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+
+            while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+                old_name, old_size = self.entries.popitem(last=False)
+                self.n_bytes -= old_size
+                stale.append(old_name)
+            self.stats["evictions"] += len(stale)
+
+        for old_name in stale:
+            try:
+                os.remove(os.path.join(self.cachedir, old_name))
+            except OSError:
+                pass
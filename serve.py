@@ -1,28 +1,36 @@
 import attachments
+import kaldiproc
 import minidb
+import resultcache
+import timeline
 import transcribe
 import numm3
+import wavstream
+import wordarray
+import wordindex
 
 from autobahn.twisted.websocket import WebSocketServerProtocol, \
                                        WebSocketServerFactory
 from autobahn.twisted.resource import WebSocketResource
-from twisted.web.resource import Resource
+from twisted.web.resource import Resource, NoResource
 from twisted.web.static import File
 from twisted.web.server import Site, NOT_DONE_YET
-from twisted.internet import reactor
+from twisted.internet import reactor, task, threads
 
+import hashlib
 import json
 import multiprocessing
 from multiprocessing.pool import ThreadPool as Pool
 import numpy as np
 import os
+import Queue
 import shutil
 import tempfile
 import time
+import traceback
 import zipfile
 
 from gentle.paths import get_resource
-from gentle.standard_kaldi import Kaldi
 import gentle.metasentence as metasentence
 import gentle.language_model as language_model
 
@@ -32,196 +40,392 @@ vocab_path = os.path.join(proto_langdir, "graphdir/words.txt")
 with open(vocab_path) as f:
     vocab = metasentence.load_vocabulary(f)
 
+# Seconds to wait for further command edits before rebuilding the graph
+LM_DEBOUNCE = 1.0
+
+# Re-run results are committed this many at a time (as one batch), every
+# RERUN_FLUSH_INTERVAL seconds; re-run threads wait while RERUN_QUEUE
+# results are waiting for the reactor.
+RERUN_BATCH = 200
+RERUN_FLUSH_INTERVAL = 0.25
+RERUN_QUEUE = 1000
+
+# Longest audio clip served, in seconds
+MAX_CLIP_LEN = 600
+# Clips change only if a session's utterances do; clients revalidate
+# with the ETag after this many seconds
+CLIP_MAX_AGE = 60
+# Bytes per write
+CLIP_CHUNK = 2**16
+
 class AudioConferenceFactory(WebSocketServerFactory):
-    def __init__(self, resources, dbdir="db", db=None):
+    def __init__(self, resources, dbdir="db", db=None, result_cache=None):
         WebSocketServerFactory.__init__(self, None)
         self.clients = {}       # peerstr -> client
 
         self.resources = resources
         
         self.db = db
-        self.gen_hclg_filename = db.gen_hclg_filename if db else None
 
-        self.rerunning = False
+        # Command decodes, by (wav hash, lm hash); may be shared
+        # between databases
+        self.result_cache = result_cache
+
+        # Bumped whenever the command language model changes; re-run
+        # jobs from older generations are abandoned.
+        self.rerun_generation = 0
+        self.rerun_pool = None
+        self.rerun_progress = None
+        self.rerun_results = Queue.Queue(RERUN_QUEUE)  # (generation, utt id, fields)
+        self.rerun_flush = task.LoopingCall(self.flush_reruns)
 
         self.dbdir = dbdir
         if not os.path.exists(dbdir):
             os.makedirs(dbdir)
 
+    def recover_audio(self):
+        # Utterance audio that was still being written when a previous
+        # run stopped. Sessions write into a directory named for their
+        # peer, so a `.part' there can only be from the peer's last
+        # session.
+        sessions = {}           # peer -> session doc
+        for doc in self.db.find("type", "session"):
+            if "peer" in doc and doc.get("s_time", 0) >= sessions.get(doc["peer"], {}).get("s_time", 0):
+                sessions[doc["peer"]] = doc
+
+        d = threads.deferToThread(self.import_recovered,
+                                  dict([(X, sessions[X]["_id"]) for X in sessions]))
+        d.addCallback(lambda found: [self.sendAudio(*X) for X in found])
+        d.addErrback(lambda err: err.printTraceback())
+        return d
+
+    def import_recovered(self, sessions):
+        # (in a thread) returns [(wavpath, start, duration, utt_idx, session_id)]
+        found = []
+        for peer, session_id in sessions.items():
+            outdir = os.path.join(self.dbdir, peer)
+            if not os.path.isdir(outdir):
+                continue
+            for filename in os.listdir(outdir):
+                if not filename.endswith('.wav.part'):
+                    continue
+                try:
+                    path = wavstream.recover(os.path.join(outdir, filename))
+                    mm, _offset, n_samples = wavstream.map_samples(path)
+                    mm.close()
+                except (EnvironmentError, ValueError) as e:
+                    print 'could not recover', filename, e
+                    continue
+                name = transcribe.parse_wav_filename(os.path.basename(path))
+                if name is None or n_samples == 0:
+                    print 'recovered but not attached', path
+                    continue
+
+                utt_idx, start = name
+                wavpath = self.resources['attach'].import_wav(path)
+                print 'recovered', path, 'as', session_id, utt_idx
+                found.append((wavpath, start / float(transcribe.SAMPLE_RATE),
+                              n_samples / float(transcribe.SAMPLE_RATE), utt_idx, session_id))
+        return found
+
+    def resume_backlog(self):
+        # Utterances left pending by a previous run
+        for doc in self.db.find("type", "utterance"):
+            if doc.get("transcript_pending") and "wavpath" in doc:
+                self.backlog_utterance(doc)
+
+    def backlog_utterance(self, doc):
+        # Transcribes an utterance that was only recorded, from its
+        # audio in the attachment store
+        transcribe.backlog.put(os.path.join(self.resources['attach'].attachdir, doc['wavpath']),
+                               doc["utt-idx"], doc.get("start", 0),
+                               SocketResults.backlog_onresult(self, doc["session"]))
+
+    @property
+    def gen_hclg_filename(self):
+        # None until the command graph has first been built
+        if self.db is None or self.db.lm_hash is None:
+            return None
+        return self.db.gen_hclg_filename
+
     def register(self, client):
         self.clients[client.peer] = client
 
-    def endSession(self, client, timestamp):
-        pass
+    def endSession(self, session_id):
+        # All of the session's audio has been decoded (or deferred);
+        # audio commands at its end needn't wait for another utterance
+        self.db.onchange(None, minidb.make_patch(session_id, {"ended": True}))
+        self.check_pending_audio_commands(session_id)
 
-    def sendPreview(self, p, utt_idx, session_id):
+    def utterance_fields(self, utt_idx, session_id):
+        # Utterances are updated with patches of just the fields that
+        # changed; the first patch creates the doc.
         utt_id = "utt-%s-%d" % (session_id, utt_idx)
+        if self.db.get(utt_id) is not None:
+            return utt_id, {}
+        return utt_id, {"_id": utt_id,
+                        "type": "utterance",
+                        "session": session_id,
+                        "utt-idx": utt_idx}
 
-        # Update the preview doc if it exists
-        doc = self.db.get(utt_id, {
-            "_id": utt_id,
-            "type": "utterance",
-            "session": session_id,
-            "utt-idx": utt_idx})
-        doc[p["type"]] = p["text"]
+    def sendPreview(self, p, utt_idx, session_id):
+        utt_id, fields = self.utterance_fields(utt_idx, session_id)
+        fields[p["type"]] = p["text"]
 
-        self.db.onchange(None, {"type": "change",
-                                "id": utt_id,
-                                "doc": doc})
+        self.db.onpreview(minidb.make_patch(utt_id, fields))
 
     def sendResult(self, res, utt_idx, session_id):
-        utt_id = "utt-%s-%d" % (session_id, utt_idx)
-
-        # Update the preview doc
-        doc = self.db[utt_id]
+        # (uploads may not have had a preview)
+        utt_id, fields = self.utterance_fields(utt_idx, session_id)
+        doc = self.db.get(utt_id, fields)
+        unset = []
 
         #print 'got utt alignment'
-        doc[res["type"] + "_words"] = res["words"]
-        #del doc[res["type"]]
+        if res.get("pending"):
+            # Only recorded; the words will come from the backlog
+            if "transcript_words" not in doc:
+                fields["transcript_pending"] = True
+        else:
+            fields[res["type"] + "_words"] = res["words"]
+            if res["type"] == "transcript" and "transcript_pending" in doc:
+                unset.append("transcript_pending")
+
+        if res["type"] == "command" and "lm_hash" in res:
+            # (from the result cache, or skipped by the gate for that
+            # graph)
+            fields['command_lm'] = res["lm_hash"]
+        elif res["type"] == "command" and res.get("hclg_mtime") == os.path.getmtime(self.gen_hclg_filename):
+            # Decoded against the current graph; no need to re-run
+            fields['command_lm'] = self.db.lm_hash
+
+        if 'start' in res:
+            # (offset of the utterance within the session's audio)
+            fields['start'] = res['start']
 
         if 'duration' in res:
-            doc['duration'] = res['duration']
+            fields['duration'] = res['duration']
 
-            # having a duration also implies that the wave file is
-            # ready; import to the database
-            reactor.callInThread(self._put_attachment, doc)
-        else:
-            self.db.onchange(None, {"type": "change",
-                                    "id": utt_id,
-                                    "doc": doc})
+        if res["type"] == "command" and "lm_hash" not in res and 'command_lm' in fields:
+            # Remember the decode, for re-runs, by its audio
+            if 'wavpath' in doc:
+                reactor.callInThread(self.cache_words, attachments.path_sha1(doc['wavpath']), fields['command_lm'], res['words'])
+            else:
+                # (once the audio is in; see `sendAudio')
+                fields['command_uncached'] = True
 
-        # make sure "start" time is set on utterances
-        self.ensure_start_times(session_id)
-        
-        self.check_pending_audio_commands()
+        self.db.onchange(None, minidb.make_patch(utt_id, fields, unset))
+
+        if fields.get("transcript_pending") and 'wavpath' in doc:
+            # (the audio came first)
+            self.backlog_utterance(self.db.get(utt_id))
+
+        self.check_pending_audio_commands(session_id)
+
+    def sendAudio(self, wavpath, start, duration, utt_idx, session_id):
+        # The utterance's audio is in the attachment store; `start' is
+        # its offset within the session's audio
+        utt_id, fields = self.utterance_fields(utt_idx, session_id)
+        fields['wavpath'] = wavpath
+        fields['start'] = start
+        fields['duration'] = duration
+
+        unset = []
+        doc = self.db.get(utt_id, {})
+        if doc.get("command_uncached"):
+            # (the command words came first, and were stored compactly;
+            # see `sendResult')
+            reactor.callInThread(self.cache_words, attachments.path_sha1(wavpath), doc['command_lm'], list(doc['command_words']))
+            unset.append("command_uncached")
+
+        self.db.onchange(None, minidb.make_patch(utt_id, fields, unset))
+
+        if self.db.get(utt_id).get("transcript_pending"):
+            # (the utterance was deferred before its audio came)
+            self.backlog_utterance(self.db.get(utt_id))
 
     def re_run_everything(self):
-        if self.rerunning:
-            print 'already running...'
+        # Starts a new generation of re-runs against the current
+        # language model, cancelling any that is still in flight.
+        self.rerun_generation += 1
+        generation = self.rerun_generation
+        lm_hash = self.db.lm_hash
+
+        # Most recent sessions first; skip anything that has already
+        # been decoded against this graph.
+        sessions = sorted(self.get_all_sessions(), key=lambda x: x.get('s_time', 0), reverse=True)
+        utts = []
+        for sess in sessions:
+            utts.extend([X for X in self.get_session_utterances(sess['_id'])
+                         if 'wavpath' in X and X.get('command_lm') != lm_hash])
+
+        print 'starting re_run_everything', generation, len(utts)
+
+        self.rerun_progress = {"_id": "_rerun",
+                               "type": "rerun",
+                               "generation": generation,
+                               "lm": lm_hash,
+                               "total": len(utts),
+                               "done": 0,
+                               "status": "running" if len(utts) > 0 else "finished"}
+        # (a copy: ours is kept up to date as results come in)
+        self.db.onchange(None, {"type": "change",
+                                "id": "_rerun",
+                                "doc": dict(self.rerun_progress)})
+
+        if self.rerun_pool is None:
+            self.rerun_pool = Pool(multiprocessing.cpu_count())
+        for utt in utts:
+            self.rerun_pool.apply_async(self.re_run, (utt, generation, lm_hash))
+
+        if len(utts) > 0 and not self.rerun_flush.running:
+            self.rerun_flush.start(RERUN_FLUSH_INTERVAL, now=False)
+
+    def flush_reruns(self):
+        # Commits the re-run results that have come in, a batch at a
+        # time, along with the progress
+        changes = []
+        done = self.rerun_progress["done"]
+        failed = self.rerun_progress.get("failed", 0)
+        while len(changes) < RERUN_BATCH:
+            try:
+                generation, utt_id, fields = self.rerun_results.get_nowait()
+            except Queue.Empty:
+                break
+
+            if generation != self.rerun_generation:
+                continue
+            done += 1
+            if fields is None:
+                # (the re-run failed; the utterance keeps its old words)
+                failed += 1
+                continue
+            utt = self.db.get(utt_id)
+            if utt is not None:
+                # (unless it was deleted meanwhile)
+                changes.append(minidb.make_patch(utt_id, fields))
+
+        if done > self.rerun_progress["done"]:
+            progress = {"done": done}
+            if failed > self.rerun_progress.get("failed", 0):
+                progress["failed"] = failed
+            if done >= self.rerun_progress["total"]:
+                progress["status"] = "finished"
+                print 'finished re_run_everything', self.rerun_generation, failed, 'failed'
+            self.rerun_progress.update(progress)
+            changes.append(minidb.make_patch("_rerun", progress))
+            self.db.onchange(None, minidb.make_batch(changes))
+
+        if self.rerun_progress["status"] == "finished" and self.rerun_results.empty():
+            self.rerun_flush.stop()
+
+    def re_run(self, utt, generation, lm_hash):
+        if generation != self.rerun_generation:
+            # Superseded by a newer language model
             return
 
-        self.rerunning = True
-        
-        utts = []
-        for sess in self.get_all_sessions():
-            utts.extend(self.get_session_utterances(sess['_id']))
-
-        # unleash the threads...
-        p = Pool(multiprocessing.cpu_count())
-        # TODO: would be good to have some sort of identifier so that
-        # these jobs can be cancelled if new commands are added.
-        print 'starting re_run_everything'
-        p.map(self.re_run, utts)
-        p.close()
-        self.rerunning = False
-        print 'finished'
-
-    def re_run(self, utt):
-        if 'wavpath' not in utt:
+        try:
+            wds = self.re_decode(utt, lm_hash)
+            fields = {"command_words": wds,
+                      "command": ' '.join([X['word'] for X in wds]),
+                      "command_lm": lm_hash}
+        except Exception:
+            # (still counts towards `done', so the run finishes)
+            traceback.print_exc()
+            fields = None
+
+        if generation != self.rerun_generation:
             return
-        
-        k = Kaldi(
-            get_resource('data/nnet_a_gpu_online'),
-            self.gen_hclg_filename,
-            get_resource('PROTO_LANGDIR'))
+
+        # Wait while the reactor is behind (unless superseded)
+        result = (generation, utt["_id"], fields)
+        while generation == self.rerun_generation:
+            try:
+                self.rerun_results.put(result, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+
+    def re_decode(self, utt, lm_hash):
+        "returns the command words for `utt' against the graph with `lm_hash'"
+        wds = self.cached_words(attachments.path_sha1(utt['wavpath']), lm_hash)
+        if wds is not None:
+            return wds
+
         audio = numm3.sound2np(
             os.path.join(self.resources['attach'].attachdir, utt['wavpath']),
             nchannels=1,
             R=8000)
-        k.push_chunk(audio.tostring())
-        wds = k.get_final()
-        k.stop()
+        # (the graph for `lm_hash' itself, rather than whichever one is
+        # installed by now, so that what we cache is what it says)
+        lm_key = transcribe.lm_kaldi_pool.get_key(
+            os.path.join(self.db.hclg_cachedir, '%s.fst' % (lm_hash)))
+        k = transcribe.lm_kaldi_pool.get(lm_key)
+        try:
+            k.push_chunk(audio.tostring())
+            wds = k.get_final()
+        except Exception:
+            # (the decoder may be in any state)
+            transcribe.lm_kaldi_pool.discard(k)
+            raise
+        transcribe.lm_kaldi_pool.put(k, lm_key)
+
         for wd in wds:
-            del wd['phones']
-        utt['command_words'] = wds
-        utt['command'] = ' '.join([X['word'] for X in wds])
-        
-        reactor.callFromThread(self.db.onchange, None, {"type": "change",
-                                                        "id": utt["_id"],
-                                                        "doc": utt})
-            
+            wd.pop('phones', None)
+        self.cache_words(attachments.path_sha1(utt['wavpath']), lm_hash, wds)
+        return wds
+
+    def cached_words(self, audio_hash, lm_hash):
+        if self.result_cache is None:
+            return None
+        return self.result_cache.get(audio_hash, lm_hash)
+
+    def cache_words(self, audio_hash, lm_hash, words):
+        if self.result_cache is not None:
+            self.result_cache.put(audio_hash, lm_hash, words)
+
+    def cached_command(self, audio_hash):
+        "returns (words, lm_hash) for a live utterance decoded before, or None"
+        lm_hash = self.db.lm_hash
+        if self.result_cache is None or lm_hash is None:
+            return None
+        words = self.result_cache.get(audio_hash, lm_hash)
+        if words is None:
+            return None
+        return words, lm_hash
 
     def get_all_sessions(self):
-        return [X for X in self.db.docs.values() if X.get("type") == 'session']
+        return self.db.find("type", "session")
     
     def get_session_utterances(self, session_id):
-        return sorted([X for X in self.db.docs.values() if X.get("type") == 'utterance' and X.get("session") == session_id], key=lambda x: x['utt-idx'])
-
-    def ensure_start_times(self, session_id):
-        utts = self.get_session_utterances(session_id)
-
-        cur_start = 0       # secs
-            
-        for utt in utts:
-            if not 'duration' in utt:
-                # utterance not sufficiently processed
+        return self.db.find("timeline", session_id)
+
+    def check_pending_audio_commands(self, session_id):
+        # Finish the session's audio commands whose audio has all been
+        # transcribed, earliest first; the rest have to wait for later
+        # utterances.
+        tl = self.db.indexes["timeline"].timeline(session_id)
+        ended = self.db.get(session_id, {}).get("ended", False)
+        while tl is not None and len(tl.pending) > 0:
+            end, start, acmd_id = tl.pending[0]
+            utt_ids = tl.window(start, end, ended)
+            if utt_ids is None:
                 return
-                
-            if not 'start' in utt:
-                # Add and save start time
-                utt['start'] = cur_start
-                self.db.onchange(None, {"type": "change",
-                                        "id": utt["_id"],
-                                        "doc": utt})
-
-            cur_start += utt['duration']
-        
-    def check_pending_audio_commands(self):
-        # Check if there are pending audio commands that can now be processed
-        for acmd in self.db._pending_audio_commands:
-            
-            utts = self.get_session_utterances(acmd["session"])
 
-            cur_start = 0       # secs
             cur_words = []
-            
-            for utt in utts:
-                if not ('transcript_words' in utt and 'command_words' in utt and 'duration' in utt):
-                    # utterance not sufficiently processed
-                    break
-
-                if utt['start'] + utt['duration'] > acmd['start']:
-                    cur_words.extend(
-                        [X['word'] for X in utt['transcript_words'] if (X['start'] + utt['start']) >= acmd['start'] and (X['start'] + utt['start']) < acmd['end'] and X['word'][0] != '['])
-
-                    if utt['start'] + utt['duration'] > acmd['end']:
-                        print 'finishing acmd', acmd
-                        
-                        # ready to finish audio command
-                        acmd['type'] = 'command'
-                        acmd['text'] = ' '.join(cur_words)
-                        # Save
-                        self.db.onchange(None, {"type": "change",
-                                                "id": acmd["_id"],
-                                                "doc": acmd})
-                        
-                        # Remove command
-                        self.db._pending_audio_commands.remove(acmd)
-                        # See if there are any more...
-                        return self.check_pending_audio_commands()
-
-                cur_start += utt['duration']
-                    
-            
-
-    def get_utt_savepath(self, uttdoc):
-        # XXX: refactor
-
-        # Returns the filepath in which transcribe.py will save the
-        # utterance wave file
-        sess = self.db[uttdoc['session']]
-        
-        return os.path.join(self.dbdir, sess['peer'], 'utt-%d.wav' % (uttdoc['utt-idx']))
+            for utt_id in utt_ids:
+                utt = self.db[utt_id]
+                words, starts, _durations = wordarray.columns(utt['transcript_words'])
+                cur_words.extend(
+                    [W for (W, S) in zip(words, starts) if (S + utt['start']) >= start and (S + utt['start']) < end and W[0] != '['])
 
-            
-    def _put_attachment(self, doc):
-
-        doc['wavpath'] = self.resources['attach'].import_file(self.get_utt_savepath(doc))
+            acmd = self.db[acmd_id]
+            print 'finishing acmd', acmd
 
-        # Finish: send notification
-        reactor.callFromThread(self.db.onchange, None, {"type": "change",
-                                                        "id": doc["_id"],
-                                                        "doc": doc})
+            # ready to finish audio command (which takes it off the
+            # timeline)
+            self.db.onchange(None, minidb.make_patch(acmd_id, {"type": "command",
+                                                               "text": ' '.join(cur_words)}))
 
 class AudioConferenceProtocol(WebSocketServerProtocol):
     def __init__(self, *a, **kw):
@@ -278,76 +482,247 @@ class AudioConferenceProtocol(WebSocketServerProtocol):
 
                 
 
-class SocketTranscriptionSession(transcribe.Session):
-    def __init__(self, outdir, factory, session_id, gen_hclg_filename=None):
-        self.factory = factory
-        self.session_id = session_id
-        transcribe.Session.__init__(self, outdir, gen_hclg_filename)
-
+class SocketResults:
+    # Sends a session's results to `factory'
     def onpreview(self, p, utt_idx):
         reactor.callFromThread(self.factory.sendPreview, p, utt_idx, self.session_id)
 
     def onresult(self, res, utt_idx):
         # simplify result
         for wd in res['words']:
-            del wd['phones']
+            wd.pop('phones', None)
         reactor.callFromThread(self.factory.sendResult, res, utt_idx, self.session_id)
 
+    def onaudio(self, wav, utt_idx, start):
+        # Straight into the attachment store, by the hash the writer
+        # has already computed
+        wavpath = self.factory.resources['attach'].import_stream(wav)
+        duration = wav.n_bytes / 2 / float(transcribe.SAMPLE_RATE)
+        reactor.callFromThread(self.factory.sendAudio, wavpath, start, duration, utt_idx, self.session_id)
+
+    def onend(self):
+        reactor.callFromThread(self.factory.endSession, self.session_id)
+
+    def command_gate(self):
+        # (read for each utterance, so that it follows command edits)
+        return self.factory.db.command_gate()
+
+    @staticmethod
+    def backlog_onresult(factory, session_id):
+        # `onresult' for a session that is no longer around
+        results = SocketResults()
+        results.factory = factory
+        results.session_id = session_id
+        return results.onresult
+
+class SocketTranscriptionSession(SocketResults, transcribe.Session):
+    def __init__(self, outdir, factory, session_id, gen_hclg_filename=None):
+        self.factory = factory
+        self.session_id = session_id
+        transcribe.Session.__init__(self, outdir, gen_hclg_filename, factory.db.command_mode)
+
+    def onaudio(self, wav, utt_idx, start):
+        # (called from `feed', on the reactor)
+        reactor.callInThread(SocketResults.onaudio, self, wav, utt_idx, start)
+
+    def ondefer(self, utt_idx, start):
+        # (the factory queues the utterance once it has both its audio
+        # and the pending result)
+        pass
+
+    def lookup_command(self, audio_hash):
+        return self.factory.cached_command(audio_hash)
+
+class SocketBatchSession(SocketResults, transcribe.BatchSession):
+    def __init__(self, outdir, factory, session_id, gen_hclg_filename=None):
+        self.factory = factory
+        self.session_id = session_id
+        transcribe.BatchSession.__init__(self, outdir, gen_hclg_filename,
+                                         command_mode=factory.db.command_mode)
+
 class CommandDatabase(minidb.DBFactory):
     # We will look for "type=command" documents, and from them
     # assemble and compile a language model
 
-    def __init__(self, dbdir="db", subdir_resources=None):
+    INDEXES = dict(minidb.DBFactory.INDEXES,
+                   timeline=timeline.TimelineIndex,
+                   words=wordindex.WordIndex)
+
+    COMPACT_FIELDS = ("transcript_words", "command_words")
+
+    def __init__(self, dbdir="db", subdir_resources=None, hclg_cachedir=None):
         self._command_seqs = {} # id -> [ks]
         self.subdir_resources = subdir_resources
 
-        self._pending_audio_commands = [] # list of docs waiting to be processed
+        # Compiled graphs, by hash of the command sequences
+        self.hclg_cachedir = hclg_cachedir or os.path.join(dbdir, '_hclg')
 
         minidb.DBFactory.__init__(self, dbdir)
 
         # XXX: re-initialize command_seqs
         # The `update_inmem` process will not update from `self.db` on launch
-        self._command_seqs = dict([(key, doc["_ks"]) for (key, doc) in self.docs.items() if doc.get("type") == "command"])
-
-        self.gen_hclg_filename = self.create_language_model()
+        self._command_seqs = dict([(key, self.docs[key]["_ks"]) for key in self.indexes["type"].get("command")])
+
+        # The current graph is always installed here; `lm_hash' is
+        # None until the first build has finished.
+        self.gen_hclg_filename = os.path.join(self.dbdir, 'HCLG.fst')
+        self.lm_hash = None
+        self.lm_gate = ([], None)   # see `command_gate'
+
+        self._lm_call = None    # pending (debounced) build
+        self._lm_building = False
+        self._lm_dirty = False
+
+        self.build_language_model()
+
+    @property
+    def command_mode(self):
+        # Set per database, in the "_config" document
+        mode = self.get("_config", {}).get("command_mode")
+        return mode if mode in transcribe.COMMAND_MODES else transcribe.COMMAND_MODE
+
+    @property
+    def command_seqs(self):
+        return [X for X in self._command_seqs.values() if len(X) > 0]
+
+    def command_gate(self):
+        "returns (command_seqs, lm_hash) for the graph in use, to gate command passes on"
+        return self.lm_gate
+
+    def schedule_language_model(self):
+        # Coalesce bursts of command edits into a single build
+        if self._lm_call is not None and self._lm_call.active():
+            self._lm_call.reset(LM_DEBOUNCE)
+        else:
+            self._lm_call = reactor.callLater(LM_DEBOUNCE, self.build_language_model)
 
-    def create_language_model(self):
-        "sets and returns hclg_filename"
+    def build_language_model(self):
+        if self._lm_building:
+            # Build again once the current one has finished
+            self._lm_dirty = True
+            return
 
-        gen_hclg_filename = language_model.make_bigram_language_model(self._command_seqs.values(), proto_langdir, conservative=True)
+        self._lm_building = True
+        self._lm_dirty = False
+
+        command_seqs = self._command_seqs.values()
+        d = threads.deferToThread(self.create_language_model, command_seqs)
+        d.addCallbacks(self._language_model_ready, self._language_model_failed,
+                       callbackArgs=(command_seqs,))
+
+    def _language_model_ready(self, lm_hash, command_seqs):
+        self._lm_building = False
+
+        prev_lm_hash = self.lm_hash
+        self.lm_hash = lm_hash
+        # (in one go, for sessions' threads)
+        self.lm_gate = ([X for X in command_seqs if len(X) > 0], lm_hash)
+
+        if self._lm_dirty:
+            self.build_language_model()
+        elif prev_lm_hash is not None and prev_lm_hash != lm_hash:
+            self.subdir_resources['factory'].re_run_everything()
+        elif prev_lm_hash is None and self.get("_rerun", {}).get("status") == "running":
+            # A re-run was cut short by a restart; start it again
+            # (whatever it got through is decoded against this graph
+            # already, and skipped)
+            self.subdir_resources['factory'].re_run_everything()
+
+    def _language_model_failed(self, err):
+        print 'failed to build language model', err
+        self._lm_building = False
+
+        if self._lm_dirty:
+            self.build_language_model()
+
+    def create_language_model(self, command_seqs):
+        "installs the graph for `command_seqs' at gen_hclg_filename and returns its hash"
+
+        # (runs in a thread)
+        lm_hash = hashlib.sha1(json.dumps(sorted(command_seqs))).hexdigest()
+        if lm_hash == self.lm_hash and os.path.exists(self.gen_hclg_filename):
+            return lm_hash
+
+        cached_filename = os.path.join(self.hclg_cachedir, '%s.fst' % (lm_hash))
+        if not os.path.exists(cached_filename):
+            print 'compiling language model', lm_hash
+            hclg_filename = language_model.make_bigram_language_model(command_seqs, proto_langdir, conservative=True)
+
+            try:
+                os.makedirs(self.hclg_cachedir)
+            except OSError:
+                pass
+            fd, tmp_filename = tempfile.mkstemp(suffix='.fst', dir=self.hclg_cachedir)
+            os.close(fd)
+            shutil.move(hclg_filename, tmp_filename)
+            os.rename(tmp_filename, cached_filename)
+
+        # Install atomically, so that decoders that are loading the old
+        # graph keep reading a complete file.
+        shutil.copyfile(cached_filename, self.gen_hclg_filename + '.tmp')
+        os.rename(self.gen_hclg_filename + '.tmp', self.gen_hclg_filename)
+
+        # Warm decoders are now stale
+        transcribe.lm_kaldi_pool.invalidate(self.gen_hclg_filename)
+
+        return lm_hash
+
+    def prepare_change(self, change_doc, pending=None):
+        # Saves the kaldi-sequence of commands; returns the doc as it
+        # will be. `pending' has the docs as earlier changes in the
+        # same batch left them (and is kept up to date).
+        if pending is None:
+            pending = {}
+
+        if change_doc["type"] == "patch":
+            if change_doc["id"] in pending:
+                doc = pending[change_doc["id"]]
+            else:
+                doc = self.get(change_doc["id"])
+            doc = minidb.patch_doc(None if doc is None else dict(doc), change_doc)
+        else:
+            doc = change_doc.get("doc", {})
 
-        # Overwrite old gen_hclg_filen
-        if hasattr(self, 'gen_hclg_filename'):
-            shutil.move(gen_hclg_filename, self.gen_hclg_filename)
-            gen_hclg_filename = self.gen_hclg_filename
+        if doc.get("type") == "command":
+            seq = metasentence.MetaSentence(doc.get("text", ""), vocab).get_kaldi_sequence()
+            if change_doc["type"] == "patch":
+                change_doc.setdefault("set", {})["_ks"] = seq
+            else:
+                change_doc["doc"]["_ks"] = seq
+            doc["_ks"] = seq
+            self._command_seqs[change_doc["id"]] = seq
+        elif change_doc["id"] in self._command_seqs:
+            # (deleted, or no longer a command)
+            del self._command_seqs[change_doc["id"]]
 
-        return gen_hclg_filename
+        pending[change_doc["id"]] = None if change_doc["type"] == "delete" else doc
+        return doc
 
     def onchange(self, sender, change_doc):
         update = False
-        if change_doc.get("doc", {}).get("type") == "command":
-            # Save kaldi-sequence from the text
-            seq = metasentence.MetaSentence(change_doc["doc"].get("text", ""), vocab).get_kaldi_sequence()
-            change_doc["doc"]["_ks"] = seq
-            self._command_seqs[change_doc["id"]] = seq
-            # Set "sender" to None so that all peers get a change update
-            sender = None
-            update = True
-        elif change_doc["type"] == 'delete' and change_doc["id"] in self._command_seqs:
-            del self._command_seqs[change_doc["id"]]
-            update = True
-        elif change_doc.get("doc", {}).get("type") == "audio-command":
-            print 'got new audio command', change_doc['doc']
-            self._pending_audio_commands.append(change_doc["doc"])
-            
-            self.subdir_resources['factory'].check_pending_audio_commands()
+        audio_sessions = set()
+        pending = {}            # _id -> doc, as of the change so far
+        for c in minidb.iter_changes(change_doc):
+            was_command = c["id"] in self._command_seqs
+            doc = self.prepare_change(c, pending)
+            if doc.get("type") == "command":
+                # Set "sender" to None so that all peers get a change update
+                sender = None
+                update = True
+            elif was_command:
+                update = True
+            elif doc.get("type") == "audio-command":
+                print 'got new audio command', doc
+                audio_sessions.add(doc["session"])
 
         minidb.DBFactory.onchange(self, sender, change_doc)
 
+        for session_id in audio_sessions:
+            # (the timeline has it now)
+            self.subdir_resources['factory'].check_pending_audio_commands(session_id)
+
         if update:
-            self.create_language_model()
-            reactor.callInThread(
-                self.subdir_resources['factory'].re_run_everything)
+            self.schedule_language_model()
 
 class TranscodingAttachFactory(attachments.AttachFactory):
     def __init__(self, factory, db, *a, **kw):
@@ -382,14 +757,10 @@ class TranscodingAttachFactory(attachments.AttachFactory):
 
         # XXX: use a tempdir
         outdir = os.path.join(self.db.dbdir, upl['filename'])
-        sess = SocketTranscriptionSession(outdir, self.factory, session_id, self.factory.gen_hclg_filename)
+        sess = SocketBatchSession(outdir, self.factory, session_id, self.factory.gen_hclg_filename)
 
-        BUF_LEN = 200
-        for chunk in numm3.sound_chunks(path, nchannels=1, R=8000, chunksize=BUF_LEN):
-            sess.feed(chunk)
-
-        sess.stop()
-        sess.join()
+        # Decode up-front and transcribe in parallel
+        sess.transcribe(numm3.sound2np(path, nchannels=1, R=transcribe.SAMPLE_RATE))
 
         # Clean up: remove the tempdir and the original upload
         os.removedirs(outdir)
@@ -410,8 +781,9 @@ class DBZipper(Resource):
         
         print 'zipping', outdir
         
-        # Copy docs into index for offline operation
-        docstr = json.dumps(self.db.docs)
+        # Copy docs into index for offline operation (with the
+        # alignments as plain lists)
+        docstr = json.dumps(self.db.docs, default=list)
         
         indexstr = open('www/command/index.html').read().replace('var db = new M.Database();',
                                                               'var _docs = %s;\nvar db = new M.Database(_docs);\nwindow.setTimeout(main,1000/10);\n' % (docstr))
@@ -450,11 +822,212 @@ class DBZipper(Resource):
         # zipres.render finishes?)
         
         
+class ClipResource(Resource):
+    # /clip?session=<id>&start=<secs>&end=<secs>: that stretch of a
+    # session's audio as a WAV, sliced out of the utterances' memory-
+    # mapped attachments. Gaps between utterances (silence that was
+    # never recorded) come back as zeros. Single byte ranges are
+    # supported.
+    isLeaf = True
+
+    def __init__(self, resources):
+        self.resources = resources
+        Resource.__init__(self)
+
+    def render_GET(self, req):
+        try:
+            session_id = req.args['session'][0]
+            first = int(round(float(req.args['start'][0]) * transcribe.SAMPLE_RATE))
+            last = int(round(float(req.args['end'][0]) * transcribe.SAMPLE_RATE))
+        except (KeyError, ValueError):
+            req.setResponseCode(400)
+            return 'session, start and end are required'
+        if first < 0 or last <= first or last - first > MAX_CLIP_LEN * transcribe.SAMPLE_RATE:
+            req.setResponseCode(400)
+            return 'bad start or end'
+
+        attachdir = self.resources['attach'].attachdir
+        utts = [X for X in self.resources['factory'].get_session_utterances(session_id)
+                if 'wavpath' in X and 'start' in X and 'duration' in X
+                and X['start'] < last / float(transcribe.SAMPLE_RATE)
+                and X['start'] + X['duration'] > first / float(transcribe.SAMPLE_RATE)]
+
+        # (attachments are named by content, so this pins the clip)
+        req.setHeader('Cache-Control', 'max-age=%d' % (CLIP_MAX_AGE))
+        etag = hashlib.sha1(json.dumps([session_id, first, last] + [[X['start'], X['wavpath']] for X in utts])).hexdigest()
+        if req.setETag('"%s"' % (etag)):
+            return ''
+
+        # [(n_bytes, data, offset)]; data is a str, an mmap, or None
+        # for zeros
+        pieces = []
+        maps = []
+        pos = first
+        try:
+            for utt in utts:
+                mm, offset, n_samples = wavstream.map_samples(os.path.join(attachdir, utt['wavpath']))
+                maps.append(mm)
+
+                utt_first = int(round(utt['start'] * transcribe.SAMPLE_RATE))
+                utt_last = min(utt_first + n_samples, last)
+                if utt_last <= pos:
+                    continue
+                if utt_first > pos:
+                    pieces.append((2 * (utt_first - pos), None, 0))
+                    pos = utt_first
+                pieces.append((2 * (utt_last - pos), mm, offset + 2 * (pos - utt_first)))
+                pos = utt_last
+        except (EnvironmentError, ValueError):
+            # (a missing or empty attachment)
+            for mm in maps:
+                mm.close()
+            req.setResponseCode(404)
+            return 'audio not found'
+        if pos < last:
+            pieces.append((2 * (last - pos), None, 0))
+
+        data_len = sum([X[0] for X in pieces])
+        pieces.insert(0, (wavstream.HEADER_LEN, wavstream.header(data_len, transcribe.SAMPLE_RATE), 0))
+        total = data_len + wavstream.HEADER_LEN
+
+        req.setHeader('Content-Type', 'audio/wav')
+        req.setHeader('Accept-Ranges', 'bytes')
+
+        byte_range = parse_range(req.getHeader('range'), total)
+        if byte_range is None:
+            byte_range = (0, total)
+        elif byte_range == (0, 0):
+            for mm in maps:
+                mm.close()
+            req.setResponseCode(416)
+            req.setHeader('Content-Range', 'bytes */%d' % (total))
+            return ''
+        else:
+            req.setResponseCode(206)
+            req.setHeader('Content-Range', 'bytes %d-%d/%d' % (byte_range[0], byte_range[1] - 1, total))
+        req.setHeader('Content-Length', str(byte_range[1] - byte_range[0]))
+
+        if req.method == 'HEAD':
+            for mm in maps:
+                mm.close()
+            return ''
+
+        ClipProducer(req, pieces, byte_range, maps).start()
+        return NOT_DONE_YET
+
+class ClipProducer:
+    # Writes the byte range of a clip a CLIP_CHUNK at a time, as the
+    # client reads it (a pull producer), so a long clip neither blocks
+    # the reactor nor sits in the transport's buffer
+    def __init__(self, req, pieces, byte_range, maps):
+        self.req = req
+        self.maps = maps
+
+        # [(data, start, end)] of what's left to write
+        self.ranges = []
+        pos = 0
+        for n_bytes, data, offset in pieces:
+            lo = max(byte_range[0], pos) - pos
+            hi = min(byte_range[1], pos + n_bytes) - pos
+            if hi > lo:
+                self.ranges.append((data, offset + lo, offset + hi))
+            pos += n_bytes
+
+    def start(self):
+        self.req.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if len(self.ranges) == 0:
+            self.req.unregisterProducer()
+            self.req.finish()
+            self.close()
+            return
+
+        data, lo, hi = self.ranges[0]
+        n = min(hi - lo, CLIP_CHUNK)
+        if lo + n == hi:
+            self.ranges.pop(0)
+        else:
+            self.ranges[0] = (data, lo + n, hi)
+        self.req.write('\0' * n if data is None else data[lo:lo + n])
+
+    def stopProducing(self):
+        # (the client went away)
+        self.ranges = []
+        self.close()
+
+    def close(self):
+        for mm in self.maps:
+            mm.close()
+        self.maps = []
+
+def parse_range(header, total):
+    "returns [start, end) for a single-range Range header, (0, 0) if unsatisfiable, or None"
+    if header is None or not header.startswith('bytes=') or ',' in header:
+        return None
+    try:
+        start, end = header[len('bytes='):].split('-')
+        if start == '':
+            # (the last `end' bytes)
+            start, end = max(0, total - int(end)), total
+        else:
+            start, end = int(start), (int(end) + 1 if end != '' else total)
+    except ValueError:
+        return None
+    end = min(end, total)
+    if start >= end:
+        return (0, 0)
+    return (start, end)
+
+class SearchResource(Resource):
+    # /search?q=<phrase>[&field=command_words][&session=<id>]
+    #        [&start=<secs>][&end=<secs>][&limit=<n>]
+    # The same as a "query" message for the "words" index.
+    isLeaf = True
+
+    def __init__(self, db):
+        self.db = db
+        Resource.__init__(self)
+
+    def render_GET(self, req):
+        params = dict([(K, V[0]) for (K, V) in req.args.items()])
+        try:
+            for key in ["start", "end"]:
+                if key in params:
+                    params[key] = float(params[key])
+            if "limit" in params:
+                params["limit"] = int(params["limit"])
+        except ValueError:
+            req.setResponseCode(400)
+            return 'bad start, end or limit'
+
+        req.setHeader('Content-Type', 'application/json')
+        return json.dumps({"results": self.db.indexes["words"].query(params)})
+
+class StatsResource(Resource):
+    # JSON counters for this database
+    isLeaf = True
+
+    def __init__(self, resources):
+        self.resources = resources
+        Resource.__init__(self)
+
+    def render_GET(self, req):
+        req.setHeader('Content-Type', 'application/json')
+        return json.dumps({
+            "changelog": self.resources['db'].changelog.stats,
+            "decoders": transcribe.decoder_stats(),
+            "command_mode": self.resources['db'].command_mode,
+            "result_cache": self.resources['factory'].result_cache.stats})
+
 class SubdirectoryContexts(Resource):
     def __init__(self, dbrootdir="db", webdir="www/command", landingdir="www/landing"):
         self.dbrootdir = dbrootdir
         self.webdir = webdir
 
+        # (shared by all databases)
+        self.result_cache = resultcache.ResultCache(os.path.join(dbrootdir, '_results'))
+
         self.file_resource = File(landingdir)
 
         Resource.__init__(self)
@@ -466,6 +1039,11 @@ class SubdirectoryContexts(Resource):
             if len(name) == 0 or "." in name:
                 return self.file_resource.getChild(name, request)
 
+            elif name.startswith("_"):
+                # (the caches shared by all databases, e.g. `_hclg' and
+                # `_results', live alongside them)
+                return NoResource()
+
             else:
                 print 'making db', name
 
@@ -473,12 +1051,12 @@ class SubdirectoryContexts(Resource):
 
                 subdir_resources = {}
 
-                dbfactory = CommandDatabase(dbdir, subdir_resources)
+                dbfactory = CommandDatabase(dbdir, subdir_resources, hclg_cachedir=os.path.join(self.dbrootdir, '_hclg'))
                 dbfactory.protocol = minidb.DBProtocol
                 dbws_resource = WebSocketResource(dbfactory)
                 subdir_resources['db'] = dbfactory
 
-                factory = AudioConferenceFactory(subdir_resources, dbdir, dbfactory)
+                factory = AudioConferenceFactory(subdir_resources, dbdir, dbfactory, self.result_cache)
                 factory.protocol = AudioConferenceProtocol
                 ws_resource = WebSocketResource(factory)
                 subdir_resources['factory'] = factory
@@ -488,10 +1066,16 @@ class SubdirectoryContexts(Resource):
                 attach.protocol = attachments.AttachProtocol
                 subdir_resources['attach'] = attach
 
+                factory.resume_backlog()
+                factory.recover_audio()
+
                 attachhttp = File(attachdir)
                 attws_resource = WebSocketResource(attach)
 
                 zipper = DBZipper(dbfactory)
+                stats = StatsResource(subdir_resources)
+                clip = ClipResource(subdir_resources)
+                search = SearchResource(dbfactory)
 
                 root = File(self.webdir)
                 dbhttp = File(dbdir)                
@@ -501,6 +1085,9 @@ class SubdirectoryContexts(Resource):
                 root.putChild('db', dbhttp)
                 root.putChild('attachments', attachhttp)
                 root.putChild('download.zip', zipper)
+                root.putChild('_stats', stats)
+                root.putChild('clip', clip)
+                root.putChild('search', search)
 
                 self.putChild(name, root)
                 return root
@@ -511,6 +1098,10 @@ class SubdirectoryContexts(Resource):
 
 if __name__=='__main__':
 
+    if transcribe.DECODER_BACKEND == "process":
+        # (before there is anything for decoder workers to inherit)
+        kaldiproc.start_launcher()
+
     site = Site(SubdirectoryContexts())
     reactor.listenTCP(9559, site, interface='0.0.0.0')
     print 'http://localhost:9559'
@@ -0,0 +1,210 @@
+import json
+import os
+import shutil
+import tempfile
+
+from autobahn.twisted.resource import WebSocketResource
+from autobahn.twisted.websocket import WebSocketClientFactory, WebSocketClientProtocol, connectWS
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+import minidb
+
+class Client(WebSocketClientProtocol):
+    # Collects what the database sends
+    def onOpen(self):
+        self.messages = []
+        self.waiting = []       # [(n_messages, Deferred)]
+        self.factory.client = self
+        self.factory.opened.callback(self)
+
+    def onMessage(self, payload, isBinary):
+        self.messages.append(minidb.loads(payload))
+        self.check()
+
+    def wait(self, n):
+        "returns a Deferred that fires with the messages once there are `n'"
+        d = defer.Deferred()
+        self.waiting.append((n, d))
+        self.check()
+        return d
+
+    def check(self):
+        for (n, d) in list(self.waiting):
+            if len(self.messages) >= n:
+                self.waiting.remove((n, d))
+                d.callback(self.messages)
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.closed.callback(None)
+
+class DatabaseTest(unittest.TestCase):
+    # A DBFactory behind twisted.web, as serve.py has it, with real
+    # websocket clients
+    def setUp(self):
+        self.dbdir = tempfile.mkdtemp()
+        self.db = minidb.DBFactory(self.dbdir)
+        self.db.protocol = minidb.DBProtocol
+
+        root = Resource()
+        root.putChild('_db', WebSocketResource(self.db))
+        self.port = reactor.listenTCP(0, Site(root), interface='127.0.0.1')
+        self.factories = []
+
+    def tearDown(self):
+        closed = []
+        for factory in self.factories:
+            if not factory.closed.called:
+                closed.append(factory.closed)
+                factory.client.transport.loseConnection()
+        for call in self.db.preview_calls.values():
+            call.cancel()
+        self.db.changelog.flush()
+        self.db.checkpoint_loop.stop()
+        closed.append(defer.maybeDeferred(self.port.stopListening))
+        return defer.DeferredList(closed).addCallback(lambda _: shutil.rmtree(self.dbdir))
+
+    def connect(self, since=None):
+        "returns a Deferred that fires with a connected Client"
+        url = 'ws://127.0.0.1:%d/_db' % (self.port.getHost().port)
+        if since is not None:
+            url += '?since=%d' % (since)
+        factory = WebSocketClientFactory(url)
+        factory.protocol = Client
+        factory.opened = defer.Deferred()
+        factory.closed = defer.Deferred()
+        self.factories.append(factory)
+        connectWS(factory)
+        return factory.opened
+
+    def change(self, _id, **fields):
+        fields["_id"] = _id
+        self.db.onchange(None, {"type": "change", "id": _id, "doc": fields})
+
+    @defer.inlineCallbacks
+    def test_history_then_changes(self):
+        self.change("a")
+        client = yield self.connect()
+        messages = yield client.wait(1)
+        self.assertEqual(messages[0]["type"], "history")
+        self.assertEqual(messages[0]["history"], {"a": {"_id": "a"}})
+        self.assertEqual(messages[0]["seq"], 1)
+
+        self.change("b")
+        messages = yield client.wait(2)
+        self.assertEqual(messages[1], {"type": "change", "id": "b", "seq": 2, "doc": {"_id": "b"}})
+        # (only sent once it was in the log)
+        self.assertEqual(len(open(os.path.join(self.dbdir, '_changes')).readlines()), 2)
+
+    @defer.inlineCallbacks
+    def test_reconnect_gets_missed_changes(self):
+        for idx in range(3):
+            self.change("a", n=idx)
+        self.db.changelog.flush()
+
+        client = yield self.connect(since=1)
+        messages = yield client.wait(1)
+        self.assertEqual(messages[0]["type"], "changes")
+        self.assertEqual([X["seq"] for X in messages[0]["changes"]], [2, 3])
+
+    @defer.inlineCallbacks
+    def test_too_far_behind_gets_history(self):
+        self.patch(minidb, 'RECENT_BYTES', 1000)
+        for idx in range(100):
+            self.change("a", n=idx)
+        self.db.changelog.flush()
+        self.assertTrue(self.db.recent_bytes <= 1000)
+        self.assertEqual(self.db.recent_bytes, sum([len(X) for X in self.db.recent]))
+
+        client = yield self.connect(since=1)
+        messages = yield client.wait(1)
+        self.assertEqual(messages[0]["type"], "history")
+        self.assertEqual(messages[0]["history"]["a"]["n"], 99)
+
+        client = yield self.connect(since=98)
+        messages = yield client.wait(1)
+        self.assertEqual([X["seq"] for X in messages[0]["changes"]], [99, 100])
+
+    @defer.inlineCallbacks
+    def test_slow_client_gets_skipped_previews(self):
+        client = yield self.connect()
+        yield client.wait(1)
+
+        # More than the transport buffers, so that it pauses...
+        self.change("big", data="x" * 2**20)
+        # ...and this preview is held back
+        self.db.onpreview(minidb.make_patch("a", {"text": "hel"}))
+
+        messages = yield client.wait(3)
+        self.assertEqual(messages[1]["id"], "big")
+        self.assertEqual(messages[2], {"type": "change", "id": "a", "seq": 2,
+                                       "doc": {"_id": "a", "text": "hel"}})
+
+    @defer.inlineCallbacks
+    def test_patch_and_batch_from_a_client(self):
+        sender = yield self.connect()
+        yield sender.wait(1)
+        client = yield self.connect()
+        yield client.wait(1)
+
+        sender.sendMessage(json.dumps(minidb.make_patch("a", {"text": "hello", "n": 1})))
+        sender.sendMessage(json.dumps(minidb.make_batch([
+            minidb.make_patch("a", {"text": "hello world"}, ["n"]),
+            {"type": "change", "id": "b", "doc": {"_id": "b"}}])))
+
+        messages = yield client.wait(3)
+        self.assertEqual(messages[1], {"type": "patch", "id": "a", "seq": 1,
+                                       "set": {"text": "hello", "n": 1}})
+        self.assertEqual(messages[2]["type"], "batch")
+        self.assertEqual(messages[2]["seq"], 2)
+        self.assertEqual(self.db.get("a"), {"_id": "a", "text": "hello world"})
+        self.assertEqual(self.db.get("b"), {"_id": "b"})
+        # (the sender isn't sent its own changes)
+        self.assertEqual(len(sender.messages), 1)
+
+    @defer.inlineCallbacks
+    def test_previews_in_an_interval_are_merged(self):
+        self.patch(minidb, 'PREVIEW_INTERVAL', 0.01)
+        client = yield self.connect()
+        yield client.wait(1)
+
+        self.db.onpreview(minidb.make_patch("a", {"text": "he", "n": 1}))
+        self.db.onpreview(minidb.make_patch("a", {"text": "hel"}))
+        self.db.onpreview(minidb.make_patch("a", {"text": "hello"}, ["n"]))
+
+        messages = yield client.wait(3)
+        self.assertEqual(messages[1]["set"], {"text": "he", "n": 1})
+        self.assertEqual(messages[2]["set"], {"text": "hello"})
+        self.assertEqual(messages[2]["unset"], ["n"])
+
+class MergeChangesTest(unittest.TestCase):
+    def setUp(self):
+        self.docs = {}
+
+    def apply(self, *changes):
+        for change in changes:
+            minidb.apply_change(self.docs, change)
+        return reduce(lambda first, second: minidb.merge_changes(self.docs, first, second), changes)
+
+    def test_patches(self):
+        merged = self.apply(minidb.make_patch("a", {"x": 1, "y": 1}),
+                            minidb.make_patch("a", {"x": 2}, ["y"]),
+                            minidb.make_patch("a", {"y": 3}))
+        self.assertEqual(merged, minidb.make_patch("a", {"x": 2, "y": 3}))
+
+        # (it has the same effect as the patches, from scratch)
+        docs = {}
+        minidb.apply_change(docs, merged)
+        self.assertEqual(docs, self.docs)
+
+    def test_patch_after_a_change_gives_the_doc(self):
+        merged = self.apply({"type": "change", "id": "a", "doc": {"_id": "a", "x": 1}},
+                            minidb.make_patch("a", {"y": 2}))
+        self.assertEqual(merged, {"type": "change", "id": "a", "doc": {"_id": "a", "x": 1, "y": 2}})
+
+    def test_later_change_wins(self):
+        delete = {"type": "delete", "id": "a"}
+        self.assertEqual(self.apply(minidb.make_patch("a", {"x": 1}), delete), delete)
+        self.assertEqual(self.docs, {})
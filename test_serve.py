@@ -0,0 +1,220 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.web.resource import NoResource
+from twisted.web.test.requesthelper import DummyRequest
+
+import attachments
+import minidb
+import serve
+import transcribe
+import wavstream
+
+class ResumeBacklogTest(unittest.TestCase):
+    def setUp(self):
+        self.dbdir = tempfile.mkdtemp()
+
+        # (record jobs instead of transcribing them)
+        self.jobs = []
+        transcribe.backlog.put = lambda *job: self.jobs.append(job)
+
+    def tearDown(self):
+        del transcribe.backlog.put
+        shutil.rmtree(self.dbdir)
+
+    def test_open_with_pending_utterance(self):
+        db = minidb.DBFactory(self.dbdir)
+        db.onchange(None, {"type": "change",
+                           "id": "utt-session-1-0",
+                           "doc": {"_id": "utt-session-1-0",
+                                   "type": "utterance",
+                                   "session": "session-1",
+                                   "utt-idx": 0,
+                                   "start": 1.5,
+                                   "wavpath": "ab/cdef.wav",
+                                   "transcript_pending": True}})
+        db.changelog.flush()
+
+        # Reopen
+        db = minidb.DBFactory(self.dbdir)
+        attach = attachments.AttachFactory(os.path.join(self.dbdir, "_attachments"))
+        factory = serve.AudioConferenceFactory({'attach': attach}, self.dbdir, db=db)
+        factory.resume_backlog()
+
+        self.assertEqual([X[:3] for X in self.jobs], [(os.path.join(attach.attachdir, "ab/cdef.wav"), 0, 1.5)])
+
+    def test_deferred_utterance_is_queued_once_its_audio_is_in(self):
+        db = serve.CommandDatabase(self.dbdir, {})
+        attach = attachments.AttachFactory(os.path.join(self.dbdir, "_attachments"))
+        factory = serve.AudioConferenceFactory({'attach': attach}, self.dbdir, db=db)
+
+        factory.sendResult({"type": "transcript", "words": [], "start": 1.5, "pending": True}, 0, "session-1")
+        self.assertEqual(self.jobs, [])
+        factory.sendAudio("ab/cdef.wav", 1.5, 2.0, 0, "session-1")
+        self.assertEqual([X[:3] for X in self.jobs], [(os.path.join(attach.attachdir, "ab/cdef.wav"), 0, 1.5)])
+
+class FakeCache:
+    # Records what would be cached
+    def __init__(self):
+        self.entries = []
+
+    def put(self, *entry):
+        self.entries.append(entry)
+
+class CommandCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dbdir = tempfile.mkdtemp()
+        self.db = serve.CommandDatabase(self.dbdir, {}, hclg_cachedir=os.path.join(self.dbdir, '_hclg'))
+        self.db._language_model_ready("hash-1", [])
+        open(self.db.gen_hclg_filename, 'w').close()
+
+        self.cache = FakeCache()
+        self.factory = serve.AudioConferenceFactory({}, self.dbdir, db=self.db, result_cache=self.cache)
+
+        # (cache in place of a thread)
+        self.callInThread = serve.reactor.callInThread
+        serve.reactor.callInThread = lambda f, *args: f(*args)
+
+    def tearDown(self):
+        serve.reactor.callInThread = self.callInThread
+        shutil.rmtree(self.dbdir)
+
+    def result(self):
+        words = [{"word": "hello", "start": 0.5, "duration": 0.25}]
+        self.factory.sendResult({"type": "command", "words": words,
+                                 "hclg_mtime": os.path.getmtime(self.db.gen_hclg_filename)},
+                                0, "session-1")
+        return words
+
+    def test_words_are_cached_when_the_audio_is_in(self):
+        self.factory.sendAudio("ab/cdef.wav", 1.5, 2.0, 0, "session-1")
+        words = self.result()
+        self.assertEqual(self.cache.entries, [("abcdef", "hash-1", words)])
+
+    def test_words_are_cached_when_the_audio_comes_after(self):
+        words = self.result()
+        self.assertEqual(self.cache.entries, [])
+        self.factory.sendAudio("ab/cdef.wav", 1.5, 2.0, 0, "session-1")
+        self.assertEqual(self.cache.entries, [("abcdef", "hash-1", words)])
+        self.assertFalse("command_uncached" in self.db.get("utt-session-1-0"))
+
+class RecoverAudioTest(unittest.TestCase):
+    def setUp(self):
+        self.dbdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dbdir)
+
+    def test_part_is_attached_to_its_utterance(self):
+        db = minidb.DBFactory(self.dbdir)
+        for session_id, s_time in [("session-1", 1), ("session-2", 2)]:
+            db.onchange(None, {"type": "change",
+                               "id": session_id,
+                               "doc": {"_id": session_id,
+                                       "type": "session",
+                                       "peer": "peer-1",
+                                       "s_time": s_time}})
+
+        # An utterance that was cut off mid-write
+        outdir = os.path.join(self.dbdir, "peer-1")
+        os.makedirs(outdir)
+        wav = wavstream.WavWriter(os.path.join(outdir, transcribe.wav_filename(3, 12000)), transcribe.SAMPLE_RATE)
+        wav.write('\1\0' * 4000)
+        wav.fh.flush()
+        sha1 = wav.hexdigest()
+
+        resources = {}
+        factory = serve.AudioConferenceFactory(resources, self.dbdir, db=db)
+        resources['attach'] = attachments.AttachFactory(os.path.join(self.dbdir, "_attachments"))
+
+        found = factory.import_recovered({"peer-1": "session-2"})
+        self.assertEqual(found, [(os.path.join(sha1[:2], sha1[2:] + '.wav'), 1.5, 0.5, 3, "session-2")])
+        self.assertEqual(os.listdir(outdir), [])
+
+    def test_part_without_a_header_is_left_alone(self):
+        outdir = os.path.join(self.dbdir, "peer-1")
+        os.makedirs(outdir)
+        filename = transcribe.wav_filename(3, 12000) + '.part'
+        open(os.path.join(outdir, filename), 'w').write('RIFF')
+
+        factory = serve.AudioConferenceFactory({}, self.dbdir, db=minidb.DBFactory(self.dbdir))
+        self.assertEqual(factory.import_recovered({"peer-1": "session-1"}), [])
+        self.assertEqual(os.listdir(outdir), [filename])
+
+class CommandDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.dbdir = tempfile.mkdtemp()
+        self.db = serve.CommandDatabase(self.dbdir, {}, hclg_cachedir=os.path.join(self.dbdir, '_hclg'))
+
+    def tearDown(self):
+        if self.db._lm_call is not None and self.db._lm_call.active():
+            self.db._lm_call.cancel()
+        shutil.rmtree(self.dbdir)
+
+    def test_patches_in_a_batch_see_each_other(self):
+        self.db.onchange(None, minidb.make_batch([
+            {"type": "change", "id": "cmd1", "doc": {"_id": "cmd1", "type": "command", "text": "hello"}},
+            minidb.make_patch("cmd1", {"text": "hello world"})]))
+        self.assertEqual(self.db.command_seqs, [["hello", "world"]])
+        self.assertEqual(self.db.get("cmd1")["_ks"], ["hello", "world"])
+
+        self.db.onchange(None, minidb.make_batch([
+            minidb.make_patch("cmd1", {"type": "note"}),
+            minidb.make_patch("cmd1", {"text": "goodbye"})]))
+        self.assertEqual(self.db.command_seqs, [])
+
+    def test_gate_follows_the_graph_in_use(self):
+        self.db.onchange(None, {"type": "change", "id": "cmd1",
+                                "doc": {"_id": "cmd1", "type": "command", "text": "hello"}})
+        self.db._language_model_ready("hash-1", [["hello"], []])
+        # (edited since; not in the graph yet)
+        self.db.onchange(None, minidb.make_patch("cmd1", {"text": "goodbye"}))
+
+        self.assertEqual(self.db.command_gate(), ([["hello"]], "hash-1"))
+
+    def test_interrupted_rerun_is_resumed(self):
+        self.db.onchange(None, {"type": "change", "id": "_rerun",
+                                "doc": {"_id": "_rerun", "type": "rerun", "status": "running"}})
+        factory = serve.AudioConferenceFactory(self.db.subdir_resources, self.dbdir, db=self.db)
+        self.db.subdir_resources['factory'] = factory
+        reruns = []
+        factory.re_run_everything = lambda: reruns.append(self.db.lm_hash)
+
+        # (the first build after a restart)
+        self.db._language_model_ready("hash-1", [])
+        self.assertEqual(reruns, ["hash-1"])
+
+class ParseRangeTest(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(serve.parse_range('bytes=0-99', 1000), (0, 100))
+        self.assertEqual(serve.parse_range('bytes=900-', 1000), (900, 1000))
+        self.assertEqual(serve.parse_range('bytes=-100', 1000), (900, 1000))
+        # (clipped to the end)
+        self.assertEqual(serve.parse_range('bytes=900-1999', 1000), (900, 1000))
+        self.assertEqual(serve.parse_range('bytes=-2000', 1000), (0, 1000))
+
+    def test_unsatisfiable(self):
+        self.assertEqual(serve.parse_range('bytes=1000-', 1000), (0, 0))
+        self.assertEqual(serve.parse_range('bytes=5-2', 1000), (0, 0))
+
+    def test_ignored(self):
+        for header in [None, 'bytes=0-1,5-6', 'items=0-1', 'bytes=a-b', 'bytes=1']:
+            self.assertEqual(serve.parse_range(header, 1000), None)
+
+class SubdirectoryContextsTest(unittest.TestCase):
+    def setUp(self):
+        self.dbrootdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dbrootdir)
+
+    def test_caches_are_not_databases(self):
+        ctx = serve.SubdirectoryContexts(self.dbrootdir)
+        for name in ['_hclg', '_results']:
+            self.assertTrue(isinstance(ctx.getChild(name, DummyRequest([name])), NoResource))
+        self.assertEqual(os.listdir(self.dbrootdir), ['_results'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+import timeline
+
+class WindowTest(unittest.TestCase):
+    def setUp(self):
+        self.tl = timeline.Timeline()
+
+    def utterance(self, utt_idx, start, duration, done=True):
+        doc = {"start": start, "duration": duration, "transcript_words": []}
+        if done:
+            doc["command_words"] = []
+        self.tl.add_utterance("utt-%d" % (utt_idx), utt_idx, doc)
+
+    def test_overlapping_utterances(self):
+        self.utterance(0, 0.0, 5.0)
+        self.utterance(1, 5.0, 5.0)
+        self.utterance(2, 10.0, 5.0)
+        self.assertEqual(self.tl.window(4.0, 6.0), ["utt-0", "utt-1"])
+        self.assertEqual(self.tl.window(6.0, 7.0), ["utt-1"])
+
+    def test_waits_for_audio_that_is_still_coming(self):
+        self.utterance(0, 0.0, 5.0)
+        self.assertEqual(self.tl.window(4.0, 6.0), None)
+
+        # (started, but not transcribed yet)
+        self.utterance(1, 5.0, 5.0, done=False)
+        self.assertEqual(self.tl.window(4.0, 6.0), None)
+
+    def test_trailing_silence(self):
+        self.utterance(0, 0.0, 5.0)
+        self.utterance(1, 10.0, 5.0, done=False)
+        self.assertEqual(self.tl.window(4.0, 8.0), ["utt-0"])
+        self.assertEqual(self.tl.window(6.0, 8.0), [])
+
+    def test_end_of_session(self):
+        self.utterance(0, 0.0, 5.0)
+        self.assertEqual(self.tl.window(4.0, 8.0), None)
+        self.assertEqual(self.tl.window(4.0, 8.0, ended=True), ["utt-0"])
+
+        self.utterance(1, 6.0, 5.0, done=False)
+        self.assertEqual(self.tl.window(4.0, 8.0, ended=True), None)
+
+if __name__ == '__main__':
+    unittest.main()
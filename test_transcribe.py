@@ -0,0 +1,129 @@
+import numpy as np
+import threading
+import unittest
+
+import transcribe
+
+R = transcribe.SAMPLE_RATE
+
+def tone(secs):
+    return (8000 * np.sin(np.arange(int(secs * R)) * 2 * np.pi * 440 / R)).astype(np.int16)
+
+def quiet(secs):
+    return np.random.RandomState(0).randint(-20, 20, int(secs * R)).astype(np.int16)
+
+class FakeDecoder:
+    # Looks alive to `is_alive' until `crash'; stopping a crashed one
+    # fails, like a ProcessKaldi's broken pipe
+    def __init__(self):
+        self._p = self
+        self.crashed = False
+
+    def poll(self):
+        return 1 if self.crashed else None
+
+    def crash(self):
+        self.crashed = True
+
+    def reset(self):
+        if self.crashed:
+            raise IOError('broken pipe')
+
+    def stop(self):
+        if self.crashed:
+            raise IOError('broken pipe')
+
+class KaldiPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.made = []
+        def new_kaldi(*args):
+            self.made.append(FakeDecoder())
+            return self.made[-1]
+        self.new_kaldi = transcribe.new_kaldi
+        transcribe.new_kaldi = new_kaldi
+
+        self.pool = transcribe.KaldiPool(minsize=1, maxsize=1)
+        # (no checker thread; `check_once' is called by hand)
+        self.pool.checker = False
+
+    def tearDown(self):
+        transcribe.new_kaldi = self.new_kaldi
+
+    def test_crashed_idle_decoder_is_replaced(self):
+        k = self.pool.get()
+        self.pool.put(k)
+        k.crash()
+
+        self.pool.check_once()
+        self.assertEqual(self.pool.n, 1)
+        self.assertEqual(len(self.made), 2)
+        self.assertTrue(self.pool.get(timeout=0) is self.made[1])
+
+    def test_decoder_that_dies_before_put_is_dropped(self):
+        k = self.pool.get()
+        def reset():
+            k.crash()
+            raise IOError('broken pipe')
+        k.reset = reset
+        self.pool.put(k)
+        self.assertEqual(self.pool.n, 0)
+
+    def test_reserve_makes_an_idle_decoder_give_way(self):
+        k = self.pool.get()
+        self.assertFalse(self.pool.reserve(timeout=0))
+
+        self.pool.put(k)
+        self.assertTrue(self.pool.reserve(timeout=0))
+        self.assertEqual(self.pool.n, 1)
+        self.assertEqual(self.pool.n_idle(), 0)
+
+        self.pool.discard()
+        self.assertEqual(self.pool.n, 0)
+
+class AdmissionTest(unittest.TestCase):
+    def test_background_work_is_limited(self):
+        admission = transcribe.Admission(max_background=1)
+        get_kaldi = lambda timeout: FakeDecoder()
+        admission.get_background(get_kaldi)
+
+        got = []
+        t = threading.Thread(target=lambda: got.append(admission.get_background(get_kaldi)))
+        t.daemon = True
+        t.start()
+        t.join(0.5)
+        self.assertEqual(got, [])
+
+        admission.put_background()
+        t.join(5)
+        self.assertEqual(len(got), 1)
+
+class SplitUtterancesTest(unittest.TestCase):
+    def assertSpans(self, audio, expected):
+        spans = transcribe.split_utterances(audio)
+        self.assertEqual(len(spans), len(expected))
+        for ((start, end), (exp_start, exp_end)) in zip(spans, expected):
+            # (to the frame)
+            self.assertTrue(abs(start - exp_start * R) <= transcribe.FRAME_LEN, (start, exp_start))
+            self.assertTrue(abs(end - exp_end * R) <= transcribe.FRAME_LEN, (end, exp_end))
+
+    def test_split_at_silence(self):
+        # (with a little of the audio before, and the silence after)
+        preroll = transcribe.PREROLL_LEN / float(R)
+        quiet_len = transcribe.QUIET_LEN / float(R)
+        self.assertSpans(np.concatenate([quiet(1), tone(6), quiet(1), tone(6), quiet(1)]),
+                         [(1 - preroll, 7 + quiet_len), (8 - preroll, 14 + quiet_len)])
+
+    def test_short_utterances_run_on(self):
+        quiet_len = transcribe.QUIET_LEN / float(R)
+        self.assertSpans(np.concatenate([tone(2), quiet(1), tone(4), quiet(1)]),
+                         [(0, 7 + quiet_len)])
+
+    def test_long_utterances_are_cut(self):
+        max_len = transcribe.MAX_UTTERANCE_LEN / float(R)
+        self.assertSpans(tone(25), [(0, max_len), (max_len, 25)])
+
+    def test_silence(self):
+        self.assertEqual(transcribe.split_utterances(quiet(3)), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import json
+import unittest
+
+import wordarray
+
+WORDS = [{"word": "hello", "start": 0.51, "duration": 0.3},
+         {"word": "world", "start": 0.81, "duration": 0.42}]
+
+class WordArrayTest(unittest.TestCase):
+    def test_looks_like_the_word_list(self):
+        words = wordarray.from_words(WORDS)
+        self.assertEqual(list(words), WORDS)
+        self.assertEqual(len(words), 2)
+        self.assertEqual(words[1], WORDS[1])
+        self.assertEqual(words[1:], WORDS[1:])
+
+    def test_other_fields_are_not_compacted(self):
+        self.assertEqual(wordarray.from_words([dict(WORDS[0], case="success")]), None)
+
+    def test_json_round_trip(self):
+        doc = {"_id": "utt-1", "transcript_words": wordarray.from_words(WORDS)}
+        saved = json.dumps(doc, default=wordarray.encode)
+        self.assertEqual(json.loads(saved)["transcript_words"]["_type"], "words")
+
+        loaded = json.loads(saved, object_hook=wordarray.decode)
+        self.assertEqual(list(loaded["transcript_words"]), WORDS)
+        self.assertEqual(loaded["_id"], "utt-1")
+
+    def test_empty_round_trip(self):
+        saved = json.dumps(wordarray.from_words([]), default=wordarray.encode)
+        self.assertEqual(list(json.loads(saved, object_hook=wordarray.decode)), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import wordarray
+import wordindex
+
+def words(text, start=0.0):
+    return wordarray.from_words([{"word": X, "start": start + idx, "duration": 0.5}
+                                 for (idx, X) in enumerate(text.split())])
+
+class QueryTest(unittest.TestCase):
+    def setUp(self):
+        self.index = wordindex.WordIndex()
+        self.utterance("utt-1", "session-1", 10.0, "turn the lights on")
+        self.utterance("utt-2", "session-1", 20.0, "lights on the turn")
+        self.utterance("utt-3", "session-2", 0.0, "the lights on and the lights off")
+
+    def utterance(self, _id, session, start, text):
+        self.index.add(_id, {"_id": _id, "type": "utterance", "session": session,
+                             "start": start, "transcript_words": words(text)})
+
+    def test_phrase(self):
+        self.assertEqual(self.index.query({"q": "lights on"}),
+                         [{"session": "session-1", "start": 12.0, "end": 13.5, "id": "utt-1"},
+                          {"session": "session-1", "start": 20.0, "end": 21.5, "id": "utt-2"},
+                          {"session": "session-2", "start": 1.0, "end": 2.5, "id": "utt-3"}])
+
+    def test_words_must_be_in_order(self):
+        self.assertEqual([X["id"] for X in self.index.query({"q": "the turn"})], ["utt-2"])
+        self.assertEqual(self.index.query({"q": "lights turn"}), [])
+        self.assertEqual(self.index.query({"q": "unheard of"}), [])
+
+    def test_every_occurrence(self):
+        self.assertEqual([X["start"] for X in self.index.query({"q": "the lights"})], [11.0, 0.0, 4.0])
+
+    def test_filters(self):
+        self.assertEqual([X["id"] for X in self.index.query({"q": "lights", "session": "session-2"})],
+                         ["utt-3", "utt-3"])
+        self.assertEqual([X["start"] for X in self.index.query({"q": "lights", "start": 12.2, "end": 21.0})],
+                         [12.0, 20.0])
+        self.assertEqual(len(self.index.query({"q": "lights", "limit": 1})), 1)
+
+    def test_changed_and_removed_utterances(self):
+        self.utterance("utt-1", "session-1", 10.0, "turn it off")
+        self.assertEqual([X["id"] for X in self.index.query({"q": "lights on", "session": "session-1"})], ["utt-2"])
+        self.index.remove("utt-2")
+        self.assertEqual(self.index.query({"q": "lights on", "session": "session-1"}), [])
+        self.assertEqual([X["id"] for X in self.index.query({"q": "it off"})], ["utt-1"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+# Per-session timelines: each session's utterances in order, where
+# they end, and the audio commands waiting on them.
+#
+# Kept as a minidb index (see `DBFactory.INDEXES'), so it is updated
+# with every change. Utterances almost always arrive (and finish) in
+# order, so an update only recomputes the timeline from the changed
+# utterance on, which is usually just the last one.
+
+import bisect
+
+class Timeline:
+    def __init__(self):
+        # Utterances, ordered by utt-idx
+        self.idxs = []          # utt-idx
+        self.ids = []           # _id
+        self.durations = []     # secs, or None
+        self.starts = []        # secs, or None
+        self.done = []          # has both transcript and command words
+
+        # ends[i] is where utterance i ends, for as long as every
+        # utterance is done (and has a start and duration)
+        self.ends = []
+
+        # Audio commands, ordered by end time: [(end, start, _id)]
+        self.pending = []
+        self.pending_keys = {}  # _id -> (end, start, _id)
+
+    def __len__(self):
+        return len(self.ids) + len(self.pending)
+
+    def get_entry(self, doc):
+        return (doc.get('duration'), doc.get('start'),
+                'transcript_words' in doc and 'command_words' in doc)
+
+    def add_utterance(self, _id, utt_idx, doc):
+        pos = bisect.bisect_left(self.idxs, utt_idx)
+        entry = self.get_entry(doc)
+        if pos < len(self.ids) and self.ids[pos] == _id:
+            if (self.durations[pos], self.starts[pos], self.done[pos]) == entry:
+                # (most updates are to other fields)
+                return
+            self.durations[pos], self.starts[pos], self.done[pos] = entry
+        else:
+            self.idxs.insert(pos, utt_idx)
+            self.ids.insert(pos, _id)
+            self.durations.insert(pos, entry[0])
+            self.starts.insert(pos, entry[1])
+            self.done.insert(pos, entry[2])
+        self.update(pos)
+
+    def remove_utterance(self, _id, utt_idx):
+        pos = bisect.bisect_left(self.idxs, utt_idx)
+        for field in [self.idxs, self.ids, self.durations, self.starts, self.done]:
+            del field[pos]
+        self.update(pos)
+
+    def update(self, pos):
+        # Recompute ends from utterance `pos' on
+        del self.ends[pos:]
+        while len(self.ends) < len(self.ids):
+            idx = len(self.ends)
+            if not self.done[idx] or self.durations[idx] is None or self.starts[idx] is None:
+                break
+            self.ends.append(self.starts[idx] + self.durations[idx])
+
+    def window(self, start, end, ended=False):
+        """returns the _ids of the utterances overlapping [start, end), or
+        None if that audio may not all have been transcribed yet
+
+        It has been once an utterance that is done ends after `end', or
+        the first that isn't done starts at or after it, or (`ended')
+        the session is over and every utterance is done."""
+        n_done = len(self.ends)
+        if n_done > 0 and self.ends[-1] > end:
+            complete = True
+        elif n_done < len(self.ids):
+            complete = self.starts[n_done] is not None and self.starts[n_done] >= end
+        else:
+            complete = ended
+        if not complete:
+            return None
+
+        first = bisect.bisect_right(self.ends, start)
+        last = bisect.bisect_right(self.ends, end)
+        return self.ids[first:min(last + 1, n_done)]
+
+    def add_command(self, _id, start, end):
+        key = (end, start, _id)
+        if self.pending_keys.get(_id) == key:
+            return
+        self.remove_command(_id)
+        self.pending_keys[_id] = key
+        bisect.insort(self.pending, key)
+
+    def remove_command(self, _id):
+        key = self.pending_keys.pop(_id, None)
+        if key is not None:
+            del self.pending[bisect.bisect_left(self.pending, key)]
+
+class TimelineIndex:
+    # session -> Timeline; `get' gives the session's utterance ids, in
+    # order, like an `Index'
+    def __init__(self):
+        self.timelines = {}     # session -> Timeline
+        self.keys = {}          # _id -> (session, utt-idx), or (session, None) for commands
+
+    def get_key(self, doc):
+        if 'session' not in doc:
+            return None
+        if doc.get('type') == 'utterance' and 'utt-idx' in doc:
+            return (doc['session'], doc['utt-idx'])
+        if doc.get('type') == 'audio-command' and 'start' in doc and 'end' in doc:
+            return (doc['session'], None)
+        return None
+
+    def add(self, _id, doc):
+        key = self.get_key(doc)
+        if self.keys.get(_id) != key:
+            self.remove(_id)
+        if key is None:
+            return
+
+        self.keys[_id] = key
+        timeline = self.timelines.setdefault(key[0], Timeline())
+        if key[1] is None:
+            timeline.add_command(_id, doc['start'], doc['end'])
+        else:
+            timeline.add_utterance(_id, key[1], doc)
+
+    def remove(self, _id):
+        key = self.keys.pop(_id, None)
+        if key is None:
+            return
+
+        timeline = self.timelines[key[0]]
+        if key[1] is None:
+            timeline.remove_command(_id)
+        else:
+            timeline.remove_utterance(_id, key[1])
+        if len(timeline) == 0:
+            del self.timelines[key[0]]
+
+    def get(self, key):
+        if key not in self.timelines:
+            return []
+        return list(self.timelines[key].ids)
+
+    def timeline(self, session_id):
+        return self.timelines.get(session_id)
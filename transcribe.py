@@ -1,184 +1,964 @@
+import collections
+import hashlib
 import json
-from Queue import Queue, Empty
+import kaldiproc
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
 import numm3
 import numpy as np
 import os
+import re
 import threading
+import time
+import traceback
+import wavstream
 
 from gentle import standard_kaldi
 from gentle.paths import get_resource
 
-N_TRANSCRIPTION_THREADS = 4
-PREVIEW_LEN = 40                # ~1s
+# General-model decoders are created on first use, and then as needed
+# up to MAX_KALDIS. Decoders idle for KALDI_IDLE_TIMEOUT seconds are
+# stopped, down to MIN_KALDIS.
+MIN_KALDIS = int(os.environ.get("EARMARK_MIN_DECODERS", 1))
+MAX_KALDIS = int(os.environ.get("EARMARK_MAX_DECODERS", multiprocessing.cpu_count()))
+KALDI_IDLE_TIMEOUT = 300
+# Seconds between checks on idle decoders
+KALDI_CHECK_INTERVAL = 10
+# Decoders that work no one is waiting on (the backlog, batch
+# transcription) may use at once; the rest are kept for live sessions
+MAX_BACKGROUND_KALDIS = int(os.environ.get("EARMARK_MAX_BACKGROUND_DECODERS", max(1, MAX_KALDIS - 1)))
 
-# Do a naive silence detection to split utterances into a suitable length
-MIN_UTTERANCE_LEN = 200         # ~5s
-MAX_UTTERANCE_LEN = 800         # ~20s
-# Minimum number of quiet utterances to trigger a split
-N_QUIET_UTTERANCES= 13          # ~1/3s
+N_TRANSCRIPTION_THREADS = MAX_BACKGROUND_KALDIS
 
-# XXX: All of the above assumes constant-length buffers, but different
-# browsers may send chunks at slightly different lengths; the server
-# should coerce to a common chunk length.
+# "thread": decoders are driven from threads in this process
+# "process": each decoder is hosted in its own worker process, and
+#            audio is handed over through shared memory
+DECODER_BACKEND = os.environ.get("EARMARK_DECODER_BACKEND", "thread")
 
+# All lengths are in samples
+SAMPLE_RATE = 8000
+PREVIEW_LEN = SAMPLE_RATE       # 1s
 
-# For full transcription
-kaldi_queue = Queue()
-for i in range(N_TRANSCRIPTION_THREADS):
-    kaldi_queue.put(standard_kaldi.Kaldi())
+# Voice activity detection splits the audio into utterances of a
+# suitable length. Incoming buffers (whatever their length) are cut
+# into fixed-length frames, and a frame is voiced if its energy is
+# well above an adaptive noise floor.
+FRAME_LEN = SAMPLE_RATE / 50    # 20ms
+MIN_UTTERANCE_LEN = 5 * SAMPLE_RATE
+MAX_UTTERANCE_LEN = 20 * SAMPLE_RATE
+# Minimum quiet to trigger a split
+QUIET_LEN = SAMPLE_RATE / 3
+# Silence between utterances is not decoded, except for this much
+# lead-in before the next one
+PREROLL_LEN = SAMPLE_RATE / 4
+
+# (log-energy units)
+SPEECH_THRESHOLD = np.log(10)   # above the noise floor
+FLOOR_RISE = 0.002              # per frame; the floor falls immediately
+INITIAL_FLOOR = np.log(100**2)  # RMS of 100
+
+# Each utterance's audio lives in a preallocated segment, long enough
+# for the longest utterance (utterances are cut short if it fills up).
+SEGMENT_LEN = 25 * SAMPLE_RATE
+# Segments per session: the current utterance, plus those still being
+# decoded.
+N_SEGMENTS = 3
+
+# How utterances are decoded against the command grammar:
+# "parallel": alongside the general model, chunk by chunk
+# "staged":   once the general model has finished the utterance
+# "gated":    staged, and only if the general transcript contains a
+#             word from one of the commands
+COMMAND_MODES = ("parallel", "staged", "gated")
+COMMAND_MODE = "parallel"
+
+# Seconds an utterance waits for a general decoder before it falls
+# back to recording only (see `Backlog')
+ADMISSION_TIMEOUT = 2.0
+# Chunk offsets an utterance keeps queued for its decoder. Each offset
+# supersedes the ones before it, so further ones are simply dropped.
+MAX_QUEUED_CHUNKS = 16
+
+class AudioBuffer:
+    # Preallocated int16 storage for a session's audio. Decoders and
+    # the WAV writer all read views of the same segment, which is
+    # recycled once every reader has released it.
+
+    def __init__(self, seglen=SEGMENT_LEN, nsegments=N_SEGMENTS):
+        self.seglen = seglen
+        if DECODER_BACKEND == "process":
+            self.data, self.path = kaldiproc.shared_array((nsegments, seglen))
+        else:
+            self.data = np.zeros((nsegments, seglen), dtype=np.int16)
+            self.path = None
+        self.free = range(nsegments)
+        self.lock = threading.Lock()
+
+    def acquire(self, nreaders):
+        with self.lock:
+            if len(self.free) > 0:
+                return Segment(self, self.free.pop(), nreaders)
+
+        # Every segment is still being decoded: overflow
+        print 'audio buffer overflow'
+        return Segment(self, None, nreaders)
+
+    def release(self, row):
+        with self.lock:
+            self.free.append(row)
+
+    def close(self):
+        # (once every segment has been released)
+        if self.path is not None:
+            os.remove(self.path)
+
+class Segment:
+    def __init__(self, audio_buffer, row, nreaders):
+        self.audio_buffer = audio_buffer
+        self.row = row
+        if row is None:
+            self.data = np.zeros(audio_buffer.seglen, dtype=np.int16)
+        else:
+            self.data = audio_buffer.data[row]
+        self.n = 0              # samples written
+        self.start = 0          # sample offset within the session
+
+        self.nreaders = nreaders
+        self.lock = threading.Lock()
+
+    def space(self):
+        return len(self.data) - self.n
+
+    def write(self, buf):
+        # (only ever called by the session; readers only read up to an
+        # offset they have been given)
+        self.data[self.n:self.n+len(buf)] = buf
+        self.n += len(buf)
+        return self.n
+
+    def view(self, start=0, end=None):
+        return self.data[start:self.n if end is None else end]
+
+    def push(self, k, start, end=None):
+        end = self.n if end is None else end
+        if self.row is None:
+            push_audio(k, self.data, start, end)
+        else:
+            push_audio(k, self.data, start, end,
+                       self.audio_buffer.path, self.row * self.audio_buffer.seglen)
+
+    def release(self):
+        with self.lock:
+            self.nreaders -= 1
+            done = self.nreaders == 0
+
+        if done and self.row is not None:
+            self.audio_buffer.release(self.row)
+
+
+def new_kaldi(*args):
+    if DECODER_BACKEND == "process":
+        return kaldiproc.ProcessKaldi(*args)
+    return standard_kaldi.Kaldi(*args)
+
+def is_alive(k):
+    if isinstance(k, kaldiproc.ProcessKaldi):
+        return k.is_alive()
+    # (standard_kaldi drives the decoder as a subprocess)
+    return k._p.poll() is None
+
+def decoder_cpu_time(k):
+    "returns the CPU seconds used by `k' so far (0 where unknown)"
+    try:
+        if isinstance(k, kaldiproc.ProcessKaldi):
+            pid = k.decoder_pid()
+        else:
+            pid = k._p.pid
+        stat = open('/proc/%d/stat' % (pid)).read()
+    except (AttributeError, IOError, kaldiproc.DecoderError):
+        return 0.0
+    # (utime and stime, counting fields from after the command name)
+    fields = stat.rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def stop_kaldi(k):
+    # (for decoders that may be broken)
+    try:
+        k.stop()
+    except Exception:
+        traceback.print_exc()
+
+class PassStats:
+    # Seconds of audio, and of decoder CPU, spent on each pass
+    # ("transcript", "command"); "command-skipped" is audio that the
+    # command grammar never had to see, and "command-deferred" audio
+    # it didn't get to see because the decoders were busy.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def add(self, name, n_samples, cpu=0.0):
+        with self.lock:
+            st = self.stats.setdefault(name, {"audio": 0.0, "cpu": 0.0})
+            st["audio"] += n_samples / float(SAMPLE_RATE)
+            st["cpu"] += cpu
+
+    def command_cpu_saved(self):
+        "returns the decoder CPU seconds the gate has saved, going by what the command pass costs"
+        with self.lock:
+            ran = self.stats.get("command", {"audio": 0.0, "cpu": 0.0})
+            skipped = self.stats.get("command-skipped", {"audio": 0.0})
+            if ran["audio"] == 0:
+                return 0.0
+            return skipped["audio"] * ran["cpu"] / ran["audio"]
+
+pass_stats = PassStats()
+
+def is_command_candidate(words, command_seqs):
+    "should an utterance with (general model) `words' get a command pass?"
+    if command_seqs is None:
+        return True
+
+    # (only if one of the commands is in there, word for word)
+    words = [X["word"] for X in words]
+    positions = {}              # word -> [idx]
+    for idx, word in enumerate(words):
+        positions.setdefault(word, []).append(idx)
+    for seq in command_seqs:
+        if len(seq) == 0:
+            continue
+        for idx in positions.get(seq[0], []):
+            if words[idx:idx + len(seq)] == list(seq):
+                return True
+    return False
+
+def push_audio(k, data, start, end, path=None, offset=0):
+    "pushes data[start:end] to `k', by reference if `data' is shared at `path'"
+    if path is not None and hasattr(k, 'push_shared'):
+        k.push_shared(path, offset + start, offset + end)
+    else:
+        # (a view, not a copy)
+        k.push_chunk(np.getbuffer(data[start:end]))
+
+class KaldiPool:
+    # Decoders for full transcription. Nothing is started until the
+    # first `get'; after that a checker thread keeps at least `minsize'
+    # healthy decoders around, and stops surplus ones that have been
+    # idle for `idle_timeout' seconds.
+
+    def __init__(self, minsize=MIN_KALDIS, maxsize=MAX_KALDIS, idle_timeout=KALDI_IDLE_TIMEOUT):
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+
+        self.cond = threading.Condition()
+        self.idle = []          # [(kaldi, time returned)], oldest first
+        self.n = 0              # decoders, idle or not (or being made)
+        self.checker = None
+
+    def get(self, timeout=None):
+        "returns a decoder, or None if none came free within `timeout' seconds"
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self.cond:
+            if self.checker is None:
+                self.checker = threading.Thread(target=self.check)
+                self.checker.daemon = True
+                self.checker.start()
+
+            while len(self.idle) == 0:
+                if self.n < self.maxsize:
+                    # Grow
+                    self.n += 1
+                    break
+
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+            else:
+                # (most recently used, so that surplus ones go idle)
+                return self.idle.pop()[0]
+
+        try:
+            return new_kaldi()
+        except Exception:
+            self.discard()
+            raise
+
+    def put(self, k):
+        if not is_alive(k):
+            # (a replacement is made when one is next needed)
+            print 'dropping crashed decoder'
+            self.discard()
+            return
+
+        try:
+            k.reset()
+        except Exception:
+            # (died since)
+            traceback.print_exc()
+            stop_kaldi(k)
+            self.discard()
+            return
+        with self.cond:
+            self.idle.append((k, time.time()))
+            self.cond.notify()
+
+    def discard(self):
+        with self.cond:
+            self.n -= 1
+            self.cond.notify()
+
+    def reserve(self, timeout=None):
+        """takes a place in the pool for some other decoder (give it back
+        with `discard'); returns False if none came free within `timeout'
+        seconds"""
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        stale = None
+        with self.cond:
+            while self.n >= self.maxsize:
+                if len(self.idle) > 0:
+                    # (the longest idle makes way)
+                    stale = self.idle.pop(0)[0]
+                    self.n -= 1
+                    break
+
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+            self.n += 1
+
+        if stale is not None:
+            stop_kaldi(stale)
+        return True
+
+    def n_idle(self):
+        return len(self.idle)
+
+    def check(self):
+        while True:
+            try:
+                self.check_once()
+            except Exception:
+                # (the pool can't do without this thread)
+                traceback.print_exc()
+            time.sleep(KALDI_CHECK_INTERVAL)
+
+    def check_once(self):
+        stale = []
+        with self.cond:
+            # Crashed while idle
+            for X in self.idle:
+                if not is_alive(X[0]):
+                    stale.append(X[0])
+            self.idle = [X for X in self.idle if X[0] not in stale]
+            self.n -= len(stale)
+
+            # Idle for too long
+            while self.n > self.minsize and len(self.idle) > 0 and time.time() - self.idle[0][1] > self.idle_timeout:
+                stale.append(self.idle.pop(0)[0])
+                self.n -= 1
+
+            n_new = max(0, self.minsize - self.n)
+            self.n += n_new
+
+        for k in stale:
+            stop_kaldi(k)
+
+        # Top up to `minsize'
+        for i in range(n_new):
+            try:
+                self.put(new_kaldi())
+            except Exception:
+                traceback.print_exc()
+                self.discard()
+
+kaldi_pool = KaldiPool()
+
+class Admission:
+    # Hands out decoders from `kaldi_pool' (or, for command decoders,
+    # places in it) to live utterances, giving up after `timeout'
+    # seconds. Background work gets them through `get_background'.
+
+    def __init__(self, timeout=ADMISSION_TIMEOUT, max_background=MAX_BACKGROUND_KALDIS):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.background = threading.Semaphore(max_background)
+        self.stats = {
+            "waiting": 0,       # utterances waiting right now
+            "admitted": 0,
+            "deferred": 0,      # gave up; recorded for the backlog
+            "wait_time": 0.0,   # seconds, in total
+            "max_wait_time": 0.0}
+
+    def get(self, get_kaldi=None):
+        "returns a decoder from `get_kaldi(timeout)' (kaldi_pool's by default), or None if none came free in time"
+        t0 = time.time()
+        with self.lock:
+            self.stats["waiting"] += 1
+
+        k = (get_kaldi or kaldi_pool.get)(timeout=self.timeout)
+
+        wait = time.time() - t0
+        with self.lock:
+            self.stats["waiting"] -= 1
+            self.stats["admitted" if k is not None else "deferred"] += 1
+            self.stats["wait_time"] += wait
+            self.stats["max_wait_time"] = max(self.stats["max_wait_time"], wait)
+        return k
+
+    def get_background(self, get_kaldi=None):
+        """returns a decoder from `get_kaldi(timeout)' (kaldi_pool's by
+        default) once no live utterance is waiting for one, and there
+        are fewer than `max_background' in background use; give the
+        place back with `put_background'"""
+        self.background.acquire()
+        while True:
+            # Live utterances go first
+            if self.stats["waiting"] > 0:
+                time.sleep(0.1)
+                continue
+            k = (get_kaldi or kaldi_pool.get)(timeout=1)
+            if k is not None:
+                return k
+
+    def put_background(self):
+        self.background.release()
+
+admission = Admission()
+
+class Backlog:
+    # Utterances that were only recorded, because no decoder was free.
+    # They are transcribed from their wave files whenever no live
+    # utterance is waiting for a decoder, and the result is passed to
+    # each job's `onresult(result, utt_idx)'.
+
+    def __init__(self):
+        self.jobs = Queue()
+        self.stats = {"done": 0, "failed": 0}
+
+        t = threading.Thread(target=self.start)
+        t.daemon = True
+        t.start()
+
+    def put(self, wavpath, utt_idx, start, onresult):
+        self.jobs.put((wavpath, utt_idx, start, onresult))
+
+    def start(self):
+        while True:
+            wavpath, utt_idx, start, onresult = self.jobs.get()
+            k = admission.get_background()
+
+            res = None
+            try:
+                audio = numm3.sound2np(wavpath, nchannels=1, R=SAMPLE_RATE)
+                cpu = decoder_cpu_time(k)
+                push_audio(k, audio, 0, len(audio))
+                res = {"type": "transcript", "words": k.get_final(), "start": start}
+                pass_stats.add("transcript", len(audio), decoder_cpu_time(k) - cpu)
+            except Exception:
+                traceback.print_exc()
+                self.stats["failed"] += 1
+            kaldi_pool.put(k)
+            admission.put_background()
+
+            if res is not None:
+                onresult(res, utt_idx)
+                self.stats["done"] += 1
+
+backlog = Backlog()
+
+def decoder_stats():
+    return dict(admission.stats,
+                decoders=kaldi_pool.n,
+                idle=kaldi_pool.n_idle(),
+                backlog=dict(backlog.stats, pending=backlog.jobs.qsize()),
+                passes=pass_stats.stats,
+                command_cpu_saved=pass_stats.command_cpu_saved())
+
+# For command-grammar transcription: at most this many idle decoders
+# are kept warm, across all databases.
+MAX_LM_KALDIS = 8
+
+class LanguageModelKaldiPool:
+    # Loading the nnet and HCLG is often slower than decoding an
+    # utterance, so decoders are reset and kept around between
+    # utterances. They are keyed by (hclg_filename, mtime), so that a
+    # graph that has been overwritten is never reused. While it is
+    # decoding, each one takes a place in `kaldi_pool', so that there
+    # are never more than MAX_KALDIS decoders at work.
+
+    def __init__(self, maxsize=MAX_LM_KALDIS):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.idle = collections.OrderedDict() # key -> [kaldi], LRU first
+
+    def get_key(self, hclg_filename):
+        return (hclg_filename, os.path.getmtime(hclg_filename))
+
+    def get(self, key, timeout=None):
+        "returns a decoder for `key', or None if there was no place for one within `timeout' seconds"
+        if not kaldi_pool.reserve(timeout):
+            return None
+
+        with self.lock:
+            ks = self.idle.pop(key, [])
+            if len(ks) > 0:
+                k = ks.pop()
+                if len(ks) > 0:
+                    self.idle[key] = ks
+                return k
+
+        try:
+            return new_kaldi(
+                get_resource('data/nnet_a_gpu_online'),
+                key[0],
+                get_resource('PROTO_LANGDIR'))
+        except Exception:
+            kaldi_pool.discard()
+            raise
+
+    def put(self, k, key):
+        if not is_alive(k):
+            kaldi_pool.discard()
+            return
+        # (if this fails, the caller `discard's it)
+        k.reset()
+
+        stale = []
+        with self.lock:
+            if os.path.exists(key[0]) and self.get_key(key[0]) == key:
+                self.idle[key] = self.idle.pop(key, []) + [k]
+            else:
+                stale.append(k)
+
+            # Evict least-recently-used decoders
+            n_idle = sum([len(X) for X in self.idle.values()])
+            while n_idle > self.maxsize:
+                old_key, ks = self.idle.popitem(last=False)
+                stale.extend(ks)
+                n_idle -= len(ks)
+
+        # (its place; idle decoders don't have one)
+        kaldi_pool.discard()
+
+        for k in stale:
+            stop_kaldi(k)
+
+    def discard(self, k):
+        # (for a decoder from `get' that has failed)
+        stop_kaldi(k)
+        kaldi_pool.discard()
+
+    def invalidate(self, hclg_filename):
+        # Called when the graph at `hclg_filename' has been rewritten
+        stale = []
+        with self.lock:
+            for key in [X for X in self.idle.keys() if X[0] == hclg_filename]:
+                stale.extend(self.idle.pop(key))
+
+        for k in stale:
+            k.stop()
+
+lm_kaldi_pool = LanguageModelKaldiPool()
+
+class VAD:
+    # Voice activity detection, over FRAME_LEN frames
+
+    def __init__(self, frame_len=FRAME_LEN):
+        self.frame_len = frame_len
+        self.rem = np.zeros(0, dtype=np.int16) # partial frame
+        self.log_floor = INITIAL_FLOOR
+
+    def process(self, buf):
+        "returns (frames, voiced) for every complete frame available"
+        if len(self.rem) > 0:
+            buf = np.concatenate([self.rem, buf])
+        n = len(buf) / self.frame_len
+        self.rem = buf[n*self.frame_len:]
+        frames = buf[:n*self.frame_len].reshape((n, self.frame_len))
+        if n == 0:
+            return frames, np.zeros(0, dtype=bool)
+
+        f = frames.astype(np.float32)
+        energy = np.log(np.einsum('ij,ij->i', f, f) / self.frame_len + 1)
+
+        # The floor at frame t is the lowest of (energy[s] + (t-s) *
+        # FLOOR_RISE) for s <= t, ie. a running minimum once the slope
+        # has been taken out.
+        t = np.arange(n)
+        floor = energy - t * FLOOR_RISE
+        floor[0] = min(floor[0], self.log_floor + FLOOR_RISE)
+        floor = np.minimum.accumulate(floor) + t * FLOOR_RISE
+        self.log_floor = floor[-1]
+
+        return frames, energy > floor + SPEECH_THRESHOLD
 
 class Utterance:
-    def __init__(self):#, outfile=None):
-        self.chunks = Queue()
-        self.results = Queue()
+    # Results are put on the session's `results' queue as (utt_idx,
+    # result), followed by (utt_idx, None) once the decoder is done.
+    n_decoders = 1
+    pass_name = "transcript"
+
+    def __init__(self, utt_idx, results, segment, ondefer=None):
+        self.utt_idx = utt_idx
+        self.results = results
+        self.segment = segment
+        self.chunks = Queue(MAX_QUEUED_CHUNKS) # segment offsets, ending with None
+        self.ended = False      # None has been taken off `chunks'
         self.stopped = False
+        self.deferred = False   # no decoder came free
+
+        # Called with (utt_idx, start) if no decoder is free, to have
+        # the session's recording of the audio transcribed later (see
+        # `Backlog')
+        self.ondefer = ondefer
 
         # Start thread
         t = threading.Thread(target=self.start)
         t.start()
 
-    def feed(self, buf):
-        self.chunks.put(buf)
+    def feed(self, end):
+        # `end' samples of the segment are ready. (There is always room
+        # left for the None from `stop'.)
+        if self.chunks.qsize() < MAX_QUEUED_CHUNKS - 1:
+            self.chunks.put(end)
 
     def stop(self):
         self.stopped = True
+        self.chunks.put(None)
 
     def get_kaldi(self):
-        return kaldi_queue.get()
+        return admission.get()
+
+    def put_kaldi(self, k):
+        kaldi_pool.put(k)
+
+    def discard_kaldi(self, k):
+        stop_kaldi(k)
+        kaldi_pool.discard()
 
     def start(self):
-        k = self.get_kaldi()
-        acc = []
+        k = None
+        try:
+            k = self.get_kaldi()
 
-        while True:
-            try:
-                chunk = self.chunks.get(timeout=0.5)
-            except Empty:
-                if self.stopped:
-                    # Feed remainder
-                    rem = len(acc) % PREVIEW_LEN
-                    if rem > 0:
-                        k.push_chunk(np.concatenate(acc[-rem:]).tostring())
-                        self.get_preview(k)
-                    break
-                else:
-                    # print self.outfile, 'waiting'
-                    continue
+            if k is None:
+                # Overloaded: record now, transcribe later
+                self.deferred = True
+                self.drain()
+                self.defer()
+            else:
+                cpu = decoder_cpu_time(k)
+                self.decode(k)
+                self.finish(k)
+                pass_stats.add(self.pass_name, self.segment.n, decoder_cpu_time(k) - cpu)
+                self.put_kaldi(k)
+        except Exception:
+            # A decoder failure only costs this utterance (and the
+            # decoder, which may be in any state)
+            traceback.print_exc()
+            if k is not None:
+                self.discard_kaldi(k)
+            self.drain()
+            self.fail()
+        finally:
+            # (the session waits for this, whatever happened)
+            self.segment.release()
+            self.results.put((self.utt_idx, None))
 
-            acc.append(chunk)
+    def drain(self):
+        # Waits for the utterance to end
+        while not self.ended:
+            self.ended = self.chunks.get() is None
 
-            if (len(acc) % PREVIEW_LEN) == 0:
-                buf = np.concatenate(acc[-PREVIEW_LEN:])
-                k.push_chunk(buf.tostring())
-                self.get_preview(k)
+    def fail(self):
+        # Try again from the backlog
+        self.defer()
+
+    def defer(self):
+        if self.segment.n == 0 or self.ondefer is None:
+            return
+
+        start = self.segment.start / float(SAMPLE_RATE)
+        self.results.put((self.utt_idx, {"type": "transcript", "words": [], "start": start, "pending": True}))
+        self.ondefer(self.utt_idx, self.segment.start)
 
-        self.finish(k, acc)
+    def decode(self, k):
+        pushed = 0              # samples given to the decoder
+
+        while True:
+            end = self.chunks.get()
+            if end is None:
+                self.ended = True
+                # Feed remainder
+                if self.segment.n > pushed:
+                    self.segment.push(k, pushed)
+                    self.get_preview(k)
+                break
+
+            if end - pushed >= PREVIEW_LEN:
+                self.segment.push(k, pushed, end)
+                pushed = end
+                self.get_preview(k)
 
     def get_preview(self, k):
-        self.results.put({"type": "transcript", "text": k.get_partial()})
+        self.results.put((self.utt_idx, {"type": "transcript", "text": k.get_partial()}))
 
-    def finish(self, k, acc):
-        final = k.get_final()
-        
-        k.reset()
-        kaldi_queue.put(k)
+    def finish(self, k):
+        self.final = k.get_final()
 
-        self.results.put({"type": "transcript", "words": final})
+        self.results.put((self.utt_idx, {"type": "transcript", "words": self.final, "start": self.segment.start / float(SAMPLE_RATE)}))
 
 class LanguageModelUtterance(Utterance):
-    def __init__(self, outfile, gen_hclg_filename, results_queue):
-        self.outfile = outfile
-        self.gen_hclg_filename = gen_hclg_filename
-        Utterance.__init__(self)
+    pass_name = "command"
 
-        # Overwrite results queue to be the same as the Utterance
-        self.results = results_queue
+    def __init__(self, utt_idx, results, segment, gen_hclg_filename):
+        self.gen_hclg_filename = gen_hclg_filename
+        Utterance.__init__(self, utt_idx, results, segment)
 
     def get_kaldi(self):
-        # In theory, we could preserve these instances through a
-        # session.
-        return standard_kaldi.Kaldi(
-            get_resource('data/nnet_a_gpu_online'),
-            self.gen_hclg_filename,
-            get_resource('PROTO_LANGDIR'))
+        self.lm_key = lm_kaldi_pool.get_key(self.gen_hclg_filename)
+        return admission.get(lambda timeout: lm_kaldi_pool.get(self.lm_key, timeout))
+
+    def put_kaldi(self, k):
+        lm_kaldi_pool.put(k, self.lm_key)
+
+    def discard_kaldi(self, k):
+        lm_kaldi_pool.discard(k)
+
+    def defer(self):
+        # (left for a re-run)
+        self.fail()
+
+    def fail(self):
+        # No words, and no graph mtime: the utterance is finished, but
+        # not marked as decoded against the current graph
+        self.results.put((self.utt_idx, {"type": "command", "words": [], "start": self.segment.start / float(SAMPLE_RATE), "duration": self.segment.n / float(SAMPLE_RATE)}))
 
     def get_preview(self, k):
-        self.results.put({"type": "command", "text": k.get_partial()})
+        self.results.put((self.utt_idx, {"type": "command", "text": k.get_partial()}))
 
-    def finish(self, k, acc):
-        # Save audio
-        if len(acc) > 0 and self.outfile is not None:
-            numm3.np2sound(np.concatenate(acc), self.outfile, R=8000)
-        else:
-            print 'empty?!', self.outfile
+    def finish(self, k):
         self.stopped = True
 
         # Align
         final = k.get_final()
-        self.results.put({"type": "command", "words": final, "duration": sum([len(X) for X in acc]) / 8000.0})
-        
-        k.stop()
+        self.put_result(final)
+
+    def put_result(self, final):
+        self.results.put((self.utt_idx, {"type": "command", "words": final, "start": self.segment.start / float(SAMPLE_RATE), "duration": self.segment.n / float(SAMPLE_RATE), "hclg_mtime": self.lm_key[1]}))
+
+class RecordedLanguageModelUtterance(LanguageModelUtterance):
+    # Reports the utterance as a command pass would, but with `words'
+    # that are already known: none, if the general model found nothing
+    # that could be a command, or a cached decode of the same audio.
+    # With `words' None, it is reported as a failed pass would be.
+
+    def __init__(self, utt_idx, results, segment, gen_hclg_filename, words, pass_name, lm_hash=None):
+        self.words = words
+        self.pass_name = pass_name
+        self.lm_hash = lm_hash
+        LanguageModelUtterance.__init__(self, utt_idx, results, segment, gen_hclg_filename)
+
+    def start(self):
+        try:
+            self.drain()
+            if self.words is None:
+                self.fail()
+            else:
+                self.lm_key = lm_kaldi_pool.get_key(self.gen_hclg_filename)
+                self.put_result(self.words)
+            pass_stats.add(self.pass_name, self.segment.n)
+        except Exception:
+            traceback.print_exc()
+            self.fail()
+        finally:
+            self.segment.release()
+            self.results.put((self.utt_idx, None))
+
+    def put_result(self, final):
+        res = {"type": "command", "words": final, "start": self.segment.start / float(SAMPLE_RATE), "duration": self.segment.n / float(SAMPLE_RATE), "hclg_mtime": self.lm_key[1]}
+        if self.lm_hash is not None:
+            # (decoded against this graph, not necessarily the current one)
+            res["lm_hash"] = self.lm_hash
+        self.results.put((self.utt_idx, res))
+
+class StagedUtterance(Utterance):
+    # The general model decodes the utterance as it comes in; the
+    # command grammar then gets the finished utterance in one go,
+    # straight from the segment (which has a reader for each). With
+    # `command_gate', which gives (command_seqs, lm_hash) as of now,
+    # utterances in which the general model didn't find any of the
+    # commands skip the second pass, and are reported as decoded
+    # against the graph with that hash. `lookup(audio_hash)' may return
+    # (words, lm_hash) from an earlier decode of the same audio. If the
+    # general pass had to be deferred, so is the command pass: it is
+    # left for a re-run.
+    n_decoders = 2
+
+    def __init__(self, utt_idx, results, segment, ondefer, gen_hclg_filename, command_gate=None, lookup=None):
+        self.gen_hclg_filename = gen_hclg_filename
+        self.command_gate = command_gate
+        self.lookup = lookup
+        self.final = None
+        Utterance.__init__(self, utt_idx, results, segment, ondefer)
+
+    def start(self):
+        Utterance.start(self)
+
+        args = (self.utt_idx, self.results, self.segment, self.gen_hclg_filename)
+
+        command_seqs, lm_hash = None, None
+        if self.command_gate is not None:
+            command_seqs, lm_hash = self.command_gate()
+
+        # (if the general pass was deferred or failed, we can't tell)
+        if self.final is not None and not is_command_candidate(self.final, command_seqs):
+            command_utt = RecordedLanguageModelUtterance(*args + ([], "command-skipped", lm_hash))
+        else:
+            cached = None
+            if self.lookup is not None and self.segment.n > 0:
+                # (the same hash as its WavWriter's)
+                try:
+                    cached = self.lookup(hashlib.sha1(np.getbuffer(self.segment.view())).hexdigest())
+                except Exception:
+                    traceback.print_exc()
+
+            if cached is not None:
+                command_utt = RecordedLanguageModelUtterance(*args + (cached[0], "command-cached", cached[1]))
+            elif self.deferred:
+                # (don't add to the load)
+                command_utt = RecordedLanguageModelUtterance(*args + (None, "command-deferred"))
+            else:
+                command_utt = LanguageModelUtterance(*args)
+        command_utt.feed(self.segment.n)
+        command_utt.stop()
 
 class MultiUtterance:
     def __init__(self, utts):
         self.utts = utts
-        self.results = self.utts[0].results
+        self.n_decoders = sum([X.n_decoders for X in utts])
 
-    def feed(self, buf):
+    def feed(self, end):
         for u in self.utts:
-            u.feed(buf)
+            u.feed(end)
     def stop(self):
         for u in self.utts:
             u.stop()
 
 class Session:
-    def __init__(self, outdir, gen_hclg_filename=None):
+    def __init__(self, outdir, gen_hclg_filename=None, command_mode=COMMAND_MODE, command_seqs=None):
         self.gen_hclg_filename = gen_hclg_filename
+        self.command_mode = command_mode
+        # (only used in "gated" mode)
+        self.command_seqs = command_seqs
 
         self.outdir = outdir
         if not os.path.exists(outdir):
             os.makedirs(outdir)
         
         self.stopped = False
-        self.idx = 0
         self.utt_idx = 0
-        self.sub_idx = 0        # idx within current utterance
+        self.n_samples = 0      # fed so far
+
+        self.vad = VAD()
+        self.preroll = np.zeros(0, dtype=np.int16)
+        self.quiet_len = 0      # trailing quiet in the current utterance
 
-        self.mean_rms = 0
-        self.n_quiet_utts = 0
+        # Shared by all utterances, see `Utterance'
+        self.results = Queue()
+        self.n_decoders = 0
+
+        self.audio = AudioBuffer()
+        self.segment = None     # of the current utterance, if any
+        self.wav = None         # WavWriter, likewise
 
-        self.utts = [self.next_utt()]
+        self.utts = []
 
         self.t = threading.Thread(target=self.start)
         self.t.start()
 
     def next_utt(self):
         self.utt_idx += 1
-        self.sub_idx = 0
-        utt = Utterance()
+        self.segment = self.audio.acquire(2 if self.gen_hclg_filename else 1)
+
         if not self.gen_hclg_filename:
-            return utt
+            utt = Utterance(self.utt_idx - 1, self.results, self.segment, self.ondefer)
+        elif self.command_mode == "parallel":
+            utt = MultiUtterance([
+                Utterance(self.utt_idx - 1, self.results, self.segment, self.ondefer),
+                LanguageModelUtterance(self.utt_idx - 1, self.results, self.segment, self.gen_hclg_filename)])
         else:
-            command_utt = LanguageModelUtterance(os.path.join(self.outdir, 'utt-%d.wav' % (self.utt_idx - 1)), self.gen_hclg_filename, utt.results)
-            return MultiUtterance([utt, command_utt])
+            utt = StagedUtterance(self.utt_idx - 1, self.results, self.segment, self.ondefer,
+                                  self.gen_hclg_filename,
+                                  self.command_gate if self.command_mode == "gated" else None,
+                                  self.lookup_command)
+
+        self.n_decoders += utt.n_decoders
+        return utt
+
+    def start_utt(self, start):
+        self.utts.append(self.next_utt())
+        self.segment.start = start
+        self.wav = wavstream.WavWriter(os.path.join(self.outdir, wav_filename(self.utt_idx - 1, start)), SAMPLE_RATE)
+        self.quiet_len = 0
+
+    def end_utt(self):
+        # (the audio is complete before any of the results are)
+        self.onaudio(self.wav, self.utt_idx - 1, self.segment.start / float(SAMPLE_RATE))
+        self.wav = None
+
+        self.utts[-1].stop()
+        self.segment = None
+
+    def write(self, buf):
+        self.wav.write(np.getbuffer(buf))
+        self.utts[-1].feed(self.segment.write(buf))
 
     def feed(self, buf):
-        self.idx += 1
-        self.sub_idx += 1
+        frames, voiced = self.vad.process(buf)
 
-        self.utts[-1].feed(buf)
+        for frame, is_voiced in zip(frames, voiced):
+            self.n_samples += len(frame)
 
-        rms = (pow(buf.astype(float), 2)).mean()
-        self.mean_rms = ((self.idx-1)*self.mean_rms + rms) / self.idx
+            if self.segment is None:
+                if not is_voiced:
+                    self.preroll = np.concatenate([self.preroll, frame])[-PREROLL_LEN:]
+                    continue
 
-        if self.sub_idx >= MIN_UTTERANCE_LEN and rms < self.mean_rms / 10:
-            self.n_quiet_utts += 1
-        else:
-            self.n_quiet_utts = 0
+                # Voice: start an utterance, with some lead-in
+                self.start_utt(self.n_samples - len(frame) - len(self.preroll))
+                self.write(self.preroll)
+                self.preroll = np.zeros(0, dtype=np.int16)
+
+            elif len(frame) > self.segment.space():
+                # Out of room: cut the utterance here
+                self.end_utt()
+                self.start_utt(self.n_samples - len(frame))
+
+            self.write(frame)
+
+            if is_voiced:
+                self.quiet_len = 0
+            else:
+                self.quiet_len += len(frame)
 
-        if self.n_quiet_utts >= N_QUIET_UTTERANCES or self.sub_idx >= MAX_UTTERANCE_LEN:
-            self.utts[-1].stop()
-            self.utts.append(self.next_utt())
+            if (self.segment.n >= MIN_UTTERANCE_LEN and self.quiet_len >= QUIET_LEN) or self.segment.n >= MAX_UTTERANCE_LEN:
+                self.end_utt()
 
     def onpreview(self, p, utt_idx):
         print "U-%d: %s" % (utt_idx, p["text"])
@@ -186,41 +966,205 @@ class Session:
     def onresult(self, r, utt_idx):
         json.dump(r, open(os.path.join(self.outdir, 'utt-%d.json' % (utt_idx)), 'w'))
 
-    def start(self):
-        cur_utt_idx = 0
+    def onaudio(self, wav, utt_idx, start):
+        wav.close()
+
+    def onend(self):
+        # (every result has been given)
+        pass
+
+    def ondefer(self, utt_idx, start):
+        # (the utterance has ended, so `onaudio' has put its recording
+        # in place)
+        backlog.put(os.path.join(self.outdir, wav_filename(utt_idx, start)),
+                    utt_idx, start / float(SAMPLE_RATE), self.onresult)
+
+    def lookup_command(self, audio_hash):
+        "returns (words, lm_hash) if audio with this (sample) sha1 has been decoded before"
+        return None
 
-        hit_results = {}        # idx -> cnt
+    def command_gate(self):
+        "returns (command_seqs, lm_hash) to gate the next utterance's command pass on"
+        return self.command_seqs, None
+
+    def start(self):
+        n_finished = 0          # decoders that have sent all results
 
         while True:
-            # lookahead
-            for utt_idx, utt in [(X, self.utts[X]) for X in range(cur_utt_idx, len(self.utts))]:
-                #ret = self.utts[cur_utt_idx].results.get()
-
-                # Is the current utterance finished?
-                if utt_idx == cur_utt_idx and hit_results.get(utt_idx, 0) == 2:
-                    cur_utt_idx += 1
-                    if cur_utt_idx >= len(self.utts):
-                        # Session ended by calling `stop.'
-                        return
-                    
-                try:
-                    ret = utt.results.get(timeout=0.01)
-                except Empty:
-                    continue
+            utt_idx, ret = self.results.get()
 
-                if 'words' in ret:
-                    self.onresult(ret, utt_idx)
-                    hit_results[utt_idx] = hit_results.get(utt_idx, 0) + 1
-                else:
-                    self.onpreview(ret, utt_idx)
+            if ret is None:
+                if utt_idx is not None:
+                    n_finished += 1
+                if self.stopped and n_finished == self.n_decoders:
+                    # Session ended by calling `stop.'
+                    self.audio.close()
+                    self.onend()
+                    return
+            elif 'words' in ret:
+                self.onresult(ret, utt_idx)
+            else:
+                self.onpreview(ret, utt_idx)
 
     def stop(self):
         self.stopped = True
-        self.utts[-1].stop()
+
+        if self.segment is not None:
+            if len(self.vad.rem) <= self.segment.space():
+                self.write(self.vad.rem)
+            self.end_utt()
+
+        # (wake up `start', in case there were no utterances)
+        self.results.put((None, None))
 
     def join(self):
         self.t.join()
 
+def wav_filename(utt_idx, start):
+    # An utterance's audio, while it is being written. `start' (in
+    # samples) is in the name so that a `.part' left by a crash can be
+    # put back in its place (see `parse_wav_filename').
+    return 'utt-%d-%d.wav' % (utt_idx, start)
+
+def parse_wav_filename(filename):
+    "returns (utt_idx, start) for a `wav_filename', or None"
+    m = re.match(r'^utt-(\d+)-(\d+)\.wav$', filename)
+    if m is None:
+        return None
+    return int(m.group(1)), int(m.group(2))
+
+def split_utterances(audio):
+    "returns the (start, end) of each utterance in `audio', as a live Session would cut them"
+    frames, voiced = VAD().process(audio)
+
+    spans = []
+    start = None
+    quiet_len = 0
+    for idx, is_voiced in enumerate(voiced):
+        pos = idx * FRAME_LEN
+        if start is None:
+            if not is_voiced:
+                continue
+            start = max(spans[-1][1] if spans else 0, pos - PREROLL_LEN)
+            quiet_len = 0
+
+        if is_voiced:
+            quiet_len = 0
+        else:
+            quiet_len += FRAME_LEN
+
+        length = pos + FRAME_LEN - start
+        if (length >= MIN_UTTERANCE_LEN and quiet_len >= QUIET_LEN) or length >= MAX_UTTERANCE_LEN:
+            spans.append((start, pos + FRAME_LEN))
+            start = None
+
+    if start is not None:
+        spans.append((start, len(audio)))
+    return spans
+
+class BatchSession:
+    # Transcribes a complete recording: it is split at silence
+    # up-front, and the utterances are decoded concurrently across the
+    # decoders that live sessions leave (see `Admission.get_background').
+    # Results are reported in order, through the same callbacks as a
+    # live Session.
+
+    def __init__(self, outdir, gen_hclg_filename=None, n_threads=N_TRANSCRIPTION_THREADS, command_mode=COMMAND_MODE, command_seqs=None):
+        self.gen_hclg_filename = gen_hclg_filename
+        self.n_threads = n_threads
+        # (utterances are always decoded in stages here; only
+        # "gated" makes a difference)
+        self.gated = command_mode == "gated"
+        self.command_seqs = command_seqs
+
+        self.outdir = outdir
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+    def transcribe(self, audio):
+        spans = split_utterances(audio)
+
+        self.path = None
+        if DECODER_BACKEND == "process":
+            # Copy once into shared memory; workers read it from there
+            shared, self.path = kaldiproc.shared_array((len(audio),))
+            shared[:] = audio
+            audio = shared
+
+        pool = ThreadPool(self.n_threads)
+        for utt_idx, results in enumerate(pool.imap(lambda X: self.decode(audio, X[0], X[1][0], X[1][1]), enumerate(spans))):
+            for ret in results:
+                self.onpreview({"type": ret["type"], "text": " ".join([X["word"] for X in ret["words"]])}, utt_idx)
+                self.onresult(ret, utt_idx)
+        pool.close()
+
+        if self.path is not None:
+            os.remove(self.path)
+        self.onend()
+
+    def decode(self, audio, utt_idx, start, end):
+        results = []
+
+        wav = wavstream.WavWriter(os.path.join(self.outdir, wav_filename(utt_idx, start)), SAMPLE_RATE)
+        wav.write(np.getbuffer(audio[start:end]))
+        self.onaudio(wav, utt_idx, start / float(SAMPLE_RATE))
+
+        k = admission.get_background()
+        cpu = decoder_cpu_time(k)
+        final = None
+        try:
+            push_audio(k, audio, start, end, self.path)
+            final = k.get_final()
+            results.append({"type": "transcript", "words": final, "start": start / float(SAMPLE_RATE)})
+        except Exception:
+            traceback.print_exc()
+        pass_stats.add("transcript", end - start, decoder_cpu_time(k) - cpu)
+        kaldi_pool.put(k)
+        admission.put_background()
+
+        if self.gen_hclg_filename:
+            lm_key = lm_kaldi_pool.get_key(self.gen_hclg_filename)
+            command = {"type": "command", "words": [], "start": start / float(SAMPLE_RATE), "duration": (end - start) / float(SAMPLE_RATE), "hclg_mtime": lm_key[1]}
+
+            command_seqs, lm_hash = self.command_gate() if self.gated else (None, None)
+            if final is not None and not is_command_candidate(final, command_seqs):
+                pass_stats.add("command-skipped", end - start)
+                if lm_hash is not None:
+                    command["lm_hash"] = lm_hash
+                results.append(command)
+                return results
+
+            k = admission.get_background(lambda timeout: lm_kaldi_pool.get(lm_key, timeout))
+            cpu = decoder_cpu_time(k)
+            try:
+                push_audio(k, audio, start, end, self.path)
+                command["words"] = k.get_final()
+                results.append(command)
+                pass_stats.add("command", end - start, decoder_cpu_time(k) - cpu)
+                lm_kaldi_pool.put(k, lm_key)
+            except Exception:
+                traceback.print_exc()
+                lm_kaldi_pool.discard(k)
+            finally:
+                admission.put_background()
+
+        return results
+
+    def onpreview(self, p, utt_idx):
+        print "U-%d: %s" % (utt_idx, p["text"])
+
+    def onresult(self, r, utt_idx):
+        json.dump(r, open(os.path.join(self.outdir, 'utt-%d.json' % (utt_idx)), 'w'))
+
+    def onaudio(self, wav, utt_idx, start):
+        wav.close()
+
+    def onend(self):
+        pass
+
+    def command_gate(self):
+        return self.command_seqs, None
+
 if __name__=='__main__':
     import sys
     # Simulate with an audio file
@@ -228,7 +1172,7 @@ if __name__=='__main__':
     OUTDIR = sys.argv[2]
 
     sess = Session(OUTDIR)
-    test_audio = numm3.sound2np(AUDIOFILE, nchannels=1, R=8000)
+    test_audio = numm3.sound2np(AUDIOFILE, nchannels=1, R=SAMPLE_RATE)
 
     cur_start = 0
     BUF_LEN = 200
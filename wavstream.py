@@ -0,0 +1,106 @@
+# Incremental WAV files for live audio
+#
+# A WavWriter appends int16 frames to `<path>.part' as they arrive and
+# hashes them as it goes, so the finished file never needs to be read
+# back. Until the writer is closed, the header's sizes say "unknown"
+# (0xFFFFFFFF), which most readers take to mean "until end of file":
+# a `.part' left behind by a crash is still playable, and `recover'
+# turns it into a regular WAV.
+
+import hashlib
+import mmap
+import os
+import struct
+
+UNKNOWN_SIZE = 0xFFFFFFFF
+HEADER_LEN = 44
+
+def header(data_len, rate, nchannels=1):
+    if data_len == UNKNOWN_SIZE:
+        riff_len = UNKNOWN_SIZE
+    else:
+        riff_len = HEADER_LEN - 8 + data_len
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       'RIFF', riff_len, 'WAVE',
+                       'fmt ', 16, 1, nchannels, rate, rate * nchannels * 2, nchannels * 2, 16,
+                       'data', data_len)
+
+class WavWriter:
+    def __init__(self, path, rate):
+        self.path = path
+        self.part_path = path + '.part'
+        self.rate = rate
+
+        self.fh = open(self.part_path, 'wb')
+        self.fh.write(header(UNKNOWN_SIZE, rate))
+        self.sha1 = hashlib.sha1()  # of the samples, not the header
+        self.n_bytes = 0            # of samples written
+
+    def write(self, buf):
+        # (`buf' holds int16 samples)
+        self.fh.write(buf)
+        self.sha1.update(buf)
+        self.n_bytes += len(buf)
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+    def close(self, path=None):
+        "finishes the header and moves the file to `path' (default: the one given at the start)"
+        self.fh.seek(0)
+        self.fh.write(header(self.n_bytes, self.rate))
+        self.fh.close()
+
+        path = path or self.path
+        os.rename(self.part_path, path)
+        return path
+
+def recover(part_path):
+    "turns a `.part' left behind by a WavWriter into a regular WAV; returns its path"
+    with open(part_path, 'r+b') as fh:
+        fh.seek(0, 2)
+        if fh.tell() < HEADER_LEN:
+            # (the header itself was cut off)
+            raise ValueError('no header in %s' % (part_path))
+        data_len = fh.tell() - HEADER_LEN
+        # (drop any half-written sample)
+        data_len -= data_len % 2
+        fh.truncate(HEADER_LEN + data_len)
+
+        fh.seek(0)
+        _riff, _riff_len, _wave, _fmt, _fmt_len, _pcm, nchannels, rate = struct.unpack('<4sI4s4sIHHI', fh.read(28))
+        fh.seek(0)
+        fh.write(header(data_len, rate, nchannels))
+
+    path = part_path[:-len('.part')]
+    os.rename(part_path, path)
+    return path
+
+def map_samples(path):
+    "returns (mmap, offset, n_samples) for the samples of the WAV at `path'"
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Walk the chunks (files from elsewhere may have more than ours)
+    pos = 12
+    while pos + 8 <= len(mm):
+        chunk_id, chunk_len = struct.unpack('<4sI', mm[pos:pos+8])
+        if chunk_id == 'data':
+            # (the size may be "unknown", or more than was written)
+            n_bytes = min(chunk_len, len(mm) - pos - 8)
+            return mm, pos + 8, n_bytes / 2
+        pos += 8 + chunk_len + chunk_len % 2
+
+    mm.close()
+    raise ValueError('no data in %s' % (path))
+
+def samples_sha1(path):
+    "returns the sha1 of the samples of the WAV at `path' (as a WavWriter's `hexdigest')"
+    mm, offset, n_samples = map_samples(path)
+    try:
+        sha1 = hashlib.sha1()
+        for pos in range(offset, offset + 2 * n_samples, 2**15):
+            sha1.update(mm[pos:min(pos + 2**15, offset + 2 * n_samples)])
+        return sha1.hexdigest()
+    finally:
+        mm.close()
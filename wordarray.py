@@ -0,0 +1,114 @@
+# Compact word alignments
+#
+# The words of a transcript are kept as one numpy record array of
+# (vocabulary id, start, duration), 12 bytes a word instead of a dict
+# apiece. A WordArray still looks like a list of {"word", "start",
+# "duration"} dicts to code that iterates over it or indexes it, but
+# those dicts are only made when asked for.
+#
+# In JSON (on disk and on the wire) a WordArray is written as columns:
+#   {"_type": "words", "word": [...], "start": <b64>, "duration": <b64>}
+# where the times are base64'd little-endian float32s. `encode' and
+# `decode' are the hooks for json.dumps and json.loads.
+
+import base64
+import numpy as np
+import threading
+
+DTYPE = np.dtype([('word', '<i4'), ('start', '<f4'), ('duration', '<f4')])
+KEYS = set(DTYPE.names)
+
+# Times are given back rounded to this many places (kaldi's are in
+# frames of 10ms; the rest is float32 noise)
+TIME_PLACES = 4
+
+class Vocabulary:
+    # Interned words; ids are only good for this process
+    def __init__(self):
+        self.ids = {}           # word -> id
+        self.words = []         # id -> word
+        self.lock = threading.Lock()
+
+    def intern(self, word):
+        _id = self.ids.get(word)
+        if _id is None:
+            with self.lock:
+                _id = self.ids.get(word)
+                if _id is None:
+                    _id = len(self.words)
+                    self.words.append(word)
+                    self.ids[word] = _id
+        return _id
+
+vocab = Vocabulary()
+
+class WordArray(object):
+    # (no per-instance __dict__: there is one of these per field of
+    # every utterance)
+    __slots__ = ('rows',)
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for (word, start, duration) in zip(*self.columns()):
+            yield {"word": word, "start": start, "duration": duration}
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(WordArray(self.rows[idx]))
+        word, start, duration = self.rows[idx]
+        return {"word": vocab.words[word],
+                "start": round(float(start), TIME_PLACES),
+                "duration": round(float(duration), TIME_PLACES)}
+
+    def __repr__(self):
+        return 'WordArray(%r)' % (list(self))
+
+    def words(self):
+        return [vocab.words[X] for X in self.rows['word'].tolist()]
+
+    def columns(self):
+        return (self.words(),
+                self.rows['start'].astype(np.float64).round(TIME_PLACES).tolist(),
+                self.rows['duration'].astype(np.float64).round(TIME_PLACES).tolist())
+
+    def encode(self):
+        return {"_type": "words",
+                "word": self.words(),
+                "start": base64.b64encode(self.rows['start'].tostring()),
+                "duration": base64.b64encode(self.rows['duration'].tostring())}
+
+def from_words(words):
+    "returns a WordArray for a list of word dicts, or None if they have other fields"
+    rows = np.zeros(len(words), dtype=DTYPE)
+    for (idx, X) in enumerate(words):
+        if not isinstance(X, dict) or set(X.keys()) != KEYS:
+            return None
+        rows[idx] = (vocab.intern(X['word']), X['start'], X['duration'])
+    return WordArray(rows)
+
+def columns(words):
+    "returns ([word], [start], [duration]) for a WordArray or a list of word dicts"
+    if isinstance(words, WordArray):
+        return words.columns()
+    return [X['word'] for X in words], [X['start'] for X in words], [X['duration'] for X in words]
+
+def encode(obj):
+    # (json.dumps `default')
+    if isinstance(obj, WordArray):
+        return obj.encode()
+    raise TypeError('%r is not JSON serializable' % (obj))
+
+def decode(obj):
+    # (json.loads `object_hook')
+    if obj.get("_type") != "words":
+        return obj
+    rows = np.zeros(len(obj["word"]), dtype=DTYPE)
+    rows['word'] = [vocab.intern(X) for X in obj["word"]]
+    rows['start'] = np.fromstring(base64.b64decode(obj["start"]), dtype='<f4')
+    rows['duration'] = np.fromstring(base64.b64decode(obj["duration"]), dtype='<f4')
+    return WordArray(rows)
@@ -0,0 +1,159 @@
+# Inverted index over the words of every utterance, for phrase search
+#
+# Kept as a minidb index (see `DBFactory.INDEXES'): it is updated with
+# every change to an utterance, whether from live transcription or a
+# re-run, and its postings are saved next to each db.json checkpoint.
+
+import numpy as np
+
+import wordarray
+
+class WordIndex:
+    # word id -> utterance ids, per field. Each utterance's words are
+    # the compact rows of its doc (see wordarray.py), shared rather
+    # than copied, so that phrases are matched by position and their
+    # times come straight out.
+    FIELDS = ("transcript_words", "command_words")
+
+    # Most hits returned by a query
+    MAX_RESULTS = 1000
+
+    # Of what `dump' gives (1 had the words too)
+    VERSION = 2
+
+    def __init__(self):
+        self.utts = {}          # _id -> (session, start, {field: (words, rows)})
+        self.postings = {}      # field -> {word id -> set([_id])}
+        for field in self.FIELDS:
+            self.postings[field] = {}
+
+    def get_rows(self, words):
+        if isinstance(words, wordarray.WordArray):
+            return words.rows
+        # (word lists with other fields aren't kept compact)
+        rows = np.zeros(len(words or []), dtype=wordarray.DTYPE)
+        for (idx, X) in enumerate(words or []):
+            rows[idx] = (wordarray.vocab.intern(X['word']), X['start'], X['duration'])
+        return rows
+
+    def make_entry(self, doc, old_entry=None):
+        # (reusing the rows of fields that haven't changed: word lists
+        # are replaced, never changed in place, so that is the ones
+        # that are the same objects as last time)
+        fields = {}
+        for field in self.FIELDS:
+            words = doc.get(field)
+            if old_entry is not None and old_entry[2][field][0] is words:
+                fields[field] = old_entry[2][field]
+            else:
+                fields[field] = (words, self.get_rows(words))
+        return (doc['session'], doc.get('start', 0), fields)
+
+    def add(self, _id, doc):
+        if doc.get('type') != 'utterance' or 'session' not in doc:
+            self.remove(_id)
+            return
+
+        old_entry = self.utts.get(_id)
+        entry = self.make_entry(doc, old_entry)
+        self.utts[_id] = entry
+
+        # Most updates, previews included, are to other fields
+        for field in self.FIELDS:
+            rows = entry[2][field][1]
+            if old_entry is not None and old_entry[2][field][1] is rows:
+                continue
+            old_words = set()
+            if old_entry is not None:
+                old_words = set(old_entry[2][field][1]['word'].tolist())
+            new_words = set(rows['word'].tolist())
+
+            postings = self.postings[field]
+            for word in old_words - new_words:
+                ids = postings[word]
+                ids.discard(_id)
+                if len(ids) == 0:
+                    del postings[word]
+            for word in new_words - old_words:
+                postings.setdefault(word, set()).add(_id)
+
+    def remove(self, _id):
+        entry = self.utts.pop(_id, None)
+        if entry is None:
+            return
+
+        for field, (_words, rows) in entry[2].items():
+            for word in set(rows['word'].tolist()):
+                ids = self.postings[field].get(word)
+                if ids is not None:
+                    ids.discard(_id)
+                    if len(ids) == 0:
+                        del self.postings[field][word]
+
+    def get(self, key):
+        # (the ids of utterances with `key' in their transcript)
+        return sorted(self.postings["transcript_words"].get(wordarray.vocab.ids.get(key), []))
+
+    def query(self, params):
+        """returns the hits for a phrase search, ordered by session and time
+
+        params: {"q": phrase, "field": "transcript_words" (default) or
+        "command_words", "session": id, "start"/"end": seconds,
+        "limit": count}; all but "q" are optional."""
+        phrase = [wordarray.vocab.ids.get(X) for X in params.get("q", "").lower().split()]
+        field = params.get("field", "transcript_words")
+        if len(phrase) == 0 or None in phrase or field not in self.postings:
+            return []
+        session = params.get("session")
+        t_start = params.get("start")
+        t_end = params.get("end")
+        limit = min(params.get("limit", self.MAX_RESULTS), self.MAX_RESULTS)
+
+        # Utterances with every word, starting from the rarest
+        postings = [self.postings[field].get(X, set()) for X in set(phrase)]
+        postings.sort(key=len)
+        ids = set(postings[0])
+        for X in postings[1:]:
+            ids &= X
+
+        hits = []
+        for _id in ids:
+            utt_session, offset, fields = self.utts[_id]
+            if session is not None and utt_session != session:
+                continue
+
+            rows = fields[field][1]
+            tokens = rows['word']
+            # (positions where the whole phrase follows)
+            idxs = np.flatnonzero(tokens[:len(tokens) - len(phrase) + 1] == phrase[0])
+            for (n, word) in enumerate(phrase[1:]):
+                idxs = idxs[tokens[idxs + n + 1] == word]
+
+            for idx in idxs.tolist():
+                last = rows[idx + len(phrase) - 1]
+                start = offset + round(float(rows[idx]['start']), wordarray.TIME_PLACES)
+                end = (offset + round(float(last['start']), wordarray.TIME_PLACES)
+                       + round(float(last['duration']), wordarray.TIME_PLACES))
+                if (t_start is not None and end <= t_start) or (t_end is not None and start >= t_end):
+                    continue
+                hits.append((utt_session, start, end, _id))
+
+        hits.sort()
+        return [{"session": X[0], "start": X[1], "end": X[2], "id": X[3]}
+                for X in hits[:limit]]
+
+    def dump(self):
+        # Only the postings: the words themselves are in the snapshot
+        return {"version": self.VERSION,
+                "postings": dict([(F, dict([(wordarray.vocab.words[W], sorted(ids)) for (W, ids) in P.items()]))
+                                  for (F, P) in self.postings.items()])}
+
+    def load(self, saved, docs):
+        if not isinstance(saved, dict) or saved.get("version") != self.VERSION:
+            raise ValueError('saved index is from another version')
+        self.__init__()
+        for (field, words) in saved["postings"].items():
+            self.postings[field] = dict([(wordarray.vocab.intern(W), set(ids)) for (W, ids) in words.items()])
+        for (_id, doc) in docs.items():
+            if doc.get('type') == 'utterance' and 'session' in doc:
+                self.utts[_id] = self.make_entry(doc)
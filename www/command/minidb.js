@@ -6,8 +6,38 @@ var M = M || {};
         return window.location.host + '/' + window.location.pathname.split('/')[1] + '/';
     }
 
+    function expand_words(key, value) {
+        // (JSON.parse reviver) Word alignments arrive as columns:
+        // {"_type": "words", "word": [...], "start": <b64>, "duration": <b64>},
+        // with the times as little-endian float32s (which are rounded
+        // to 4 places, as on the server)
+        if(!value || value._type != 'words') {
+            return value;
+        }
+        var starts = float32s(value.start);
+        var durations = float32s(value.duration);
+        return value.word.map(function(word, idx) {
+            return {"word": word, "start": starts[idx], "duration": durations[idx]};
+        });
+    }
+    function float32s(b64) {
+        var bytes = atob(b64);
+        var view = new DataView(new ArrayBuffer(bytes.length));
+        for(var i = 0; i < bytes.length; i++) {
+            view.setUint8(i, bytes.charCodeAt(i));
+        }
+        var out = [];
+        for(var i = 0; i < bytes.length; i += 4) {
+            out.push(Math.round(view.getFloat32(i, true) * 1e4) / 1e4);
+        }
+        return out;
+    }
+
     $.Database = function(offline_docs) {
         this._docs = offline_docs || {};        // id -> doc
+        this.seq = null;                        // last change seen
+        this._queries = {};                     // qid -> callback
+        this._qid = 0;
 
         if(offline_docs) {
             // Offline!
@@ -17,18 +47,24 @@ var M = M || {};
             }
         }
         else {
-            // Connect
-            var proto = window.location.protocol;
-            var wsproto = 'ws://';
-            if(proto[proto.length-2] == 's') {
-                wsproto = 'wss://';
-            }
+            this._connect();
+        }
+    }
+    $.Database.prototype._connect = function() {
+        var proto = window.location.protocol;
+        var wsproto = 'ws://';
+        if(proto[proto.length-2] == 's') {
+            wsproto = 'wss://';
+        }
 
-            var wsurl = wsproto + basepath() + "_db";
-            this.socket = new WebSocket(wsurl);
-            this.socket.onmessage = this._onmessage.bind(this)
-            this.socket.onclose = this._onclose.bind(this)
+        var wsurl = wsproto + basepath() + "_db";
+        if(this.seq !== null) {
+            // Only ask for what we've missed
+            wsurl += "?since=" + this.seq;
         }
+        this.socket = new WebSocket(wsurl);
+        this.socket.onmessage = this._onmessage.bind(this)
+        this.socket.onclose = this._onclose.bind(this)
     }
     $.Database.prototype.items = function() {
         return Object.keys(this._docs)
@@ -72,24 +108,97 @@ var M = M || {};
         }));
     }
 
+    $.Database.prototype.patchdoc = function(id, fields, unset) {
+        // Sets `fields' (and removes the `unset' ones) of an existing doc
+        var change = {"type": "patch", "id": id, "set": fields};
+        if(unset && unset.length) {
+            change.unset = unset;
+        }
+        this.onupdate(this._patch(change));
+
+        this.socket.send(JSON.stringify(change));
+    }
+    $.Database.prototype._patch = function(change) {
+        // (a patch to a missing doc creates it)
+        var doc = this._docs[change.id] || {"_id": change.id};
+        Object.keys(change.set || {}).forEach(function(k) {
+            doc[k] = change.set[k];
+        });
+        (change.unset || []).forEach(function(k) {
+            delete doc[k];
+        });
+        this._docs[change.id] = doc;
+        return doc;
+    }
+
+    $.Database.prototype.query = function(index, params, cb) {
+        // Asks the server's `index' (eg. "words"); `cb' gets the results
+        if(this.offline) {
+            cb([]);
+            return;
+        }
+        var qid = ++this._qid;
+        this._queries[qid] = cb;
+
+        var msg = {"type": "query", "index": index, "qid": qid};
+        Object.keys(params).forEach(function(k) { msg[k] = params[k]; });
+        this.socket.send(JSON.stringify(msg));
+    }
+
     $.Database.prototype._onmessage = function(e) {
-        var res = JSON.parse(e.data);
+        var res = JSON.parse(e.data, expand_words);
         if(res.type == 'history') {
-            this._docs = res.history;
-            this.onload();
+            // Snapshots arrive in chunks
+            if(res.first) {
+                this._docs = {};
+                this.seq = res.seq;
+            }
+            Object.keys(res.history)
+                .forEach(function(k) {
+                    this._docs[k] = res.history[k];
+                }, this);
+            this.seq = Math.max(this.seq, res.seq);
+            if(res.last) {
+                this.onload();
+            }
+        }
+        else if(res.type == 'changes') {
+            res.changes.forEach(this._onchange, this);
+            this.seq = Math.max(this.seq, res.seq);
+        }
+        else if(res.type == 'query-result') {
+            var cb = this._queries[res.qid];
+            delete this._queries[res.qid];
+            if(cb) {
+                cb(res.results);
+            }
+        }
+        else {
+            this._onchange(res);
+        }
+    }
+    $.Database.prototype._onchange = function(res) {
+        if(res.seq) {
+            this.seq = Math.max(this.seq, res.seq);
+        }
+        if(res.type == "batch") {
+            res.changes.forEach(this._onchange, this);
         }
         else if(res.type == "delete") {
             this.ondelete(this._docs[res.id]);
             delete this._docs[res.id];
         }
+        else if(res.type == "patch") {
+            this.onupdate(this._patch(res));
+        }
         else {
             this._docs[res.id] = res.doc;
             this.onupdate(res.doc);
         }
     }
     $.Database.prototype._onclose = function() {
-        alert("connection to database closed. will reload");
-        window.location.reload();
+        console.log("connection to database closed. reconnecting");
+        window.setTimeout(this._connect.bind(this), 1000);
     }
 
 })(M);